@@ -2,76 +2,106 @@ import logging
 from logging.handlers import RotatingFileHandler, SMTPHandler
 import os
 
-from elasticsearch import Elasticsearch
 from flask import current_app, Flask, request
+from flask.helpers import locked_cached_property
 from flask_babel import Babel, lazy_gettext as _l
-from flask_bootstrap import Bootstrap
 from flask_login import LoginManager
 from flask_mail import Mail
-from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from redis import Redis
-import rq
 
 from config import Config
+from app import (
+    compression,
+    database,
+    fastjson,
+    fragments,
+    httpcache,
+    metrics,
+    search,
+    templating,
+    translate,
+)
 
 login = LoginManager()
 login.login_view = "auth.login"
 login.login_message = _l("Please log in to access this page.")
-db = SQLAlchemy()
+db = database.RoutingSQLAlchemy()
 migrate = Migrate()
 mail = Mail()
-boostrap = Bootstrap()
-moment = Moment()
 babel = Babel()
 
+PROFILES = ("web", "worker")
+
+# Pages that background jobs link to in emails. The worker profile has no
+# blueprints, so it gets build-only rules for these; keep them in step with
+# the routes.
+WORKER_URL_RULES = [("/export_posts/<task_id>", "main.download_export")]
+
 
 @babel.localeselector
 def get_locale():
     return request.accept_languages.best_match(current_app.config["LANGUAGES"])
 
 
-def create_app(config_class=Config):
-    app = Flask(__name__)
-    app.config.from_object(Config)
+class Microblog(Flask):
+    """Flask application whose service clients are created on first use.
 
-    # Elastic Search
-    app.elasticsearch = (
-        Elasticsearch(hosts=[app.config["ELASTICSEARCH_URL"]])
-        if app.config["ELASTICSEARCH_URL"]
-        else None
-    )
+    Neither the clients nor the Elasticsearch and RQ imports are paid for by
+    processes that never use them. Tests may still assign their own.
+    """
 
-    # Redis
-    app.redis = Redis.from_url(app.config["REDIS_URL"])
-    app.task_queue = rq.Queue("microblog-tasks", connection=app.redis)
+    @locked_cached_property
+    def elasticsearch(self):
+        if not self.config["ELASTICSEARCH_URL"]:
+            return None
+        from elasticsearch import Elasticsearch
 
-    # Plugins
-    login.init_app(app)
-    db.init_app(app)
-    migrate.init_app(app, db)
-    mail.init_app(app)
-    boostrap.init_app(app)
-    moment.init_app(app)
-    babel.init_app(app)
+        return Elasticsearch(hosts=[self.config["ELASTICSEARCH_URL"]])
 
-    # Blueprints
-    from app.auth import bp as auth_bp  # noqa: F402,F401
+    @locked_cached_property
+    def search_backend(self):
+        return search.create_backend(self)
 
-    app.register_blueprint(auth_bp, url_prefix="/auth")
+    @locked_cached_property
+    def translator(self):
+        return translate.create_provider(self)
 
-    from app.errors import bp as errors_bp  # noqa: F402,F401
+    @locked_cached_property
+    def redis(self):
+        return Redis.from_url(self.config["REDIS_URL"])
 
-    app.register_blueprint(errors_bp)
+    @locked_cached_property
+    def task_queue(self):
+        import rq
 
-    from app.main import bp as main_bp  # noqa: F402,F401
+        return rq.Queue("microblog-tasks", connection=self.redis)
 
-    app.register_blueprint(main_bp)
 
-    from app.api import bp as api_bp  # noqa: F402,F401
+def create_app(config_class=Config, profile="web"):
+    """Create the application.
 
-    app.register_blueprint(api_bp, url_prefix="/api")
+    The "worker" profile, used by RQ jobs, leaves out the blueprints, request
+    hooks and page template setup that only serving requests needs.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown app profile {profile!r}")
+
+    app = Microblog(__name__)
+    app.config.from_object(config_class)
+    fastjson.init_app(app)
+    templating.init_app(app)
+
+    # Plugins
+    db.init_app(app)
+    mail.init_app(app)
+    babel.init_app(app)
+
+    if profile == "web":
+        _init_web(app)
+    else:
+        for rule, endpoint in WORKER_URL_RULES:
+            app.add_url_rule(rule, endpoint, build_only=True)
 
     if not app.debug and not app.testing:
         if app.config["MAIL_SERVER"]:
@@ -124,4 +154,41 @@ def create_app(config_class=Config):
     return app
 
 
+def _init_web(app):
+    from flask_bootstrap import Bootstrap
+    from flask_moment import Moment
+
+    # Registered first, so that it runs after every other after_request hook
+    compression.init_app(app)
+
+    login.init_app(app)
+    database.init_app(app)
+    migrate.init_app(app, db)
+    Bootstrap(app)
+    Moment(app)
+    app.add_template_global(fragments.render_posts)
+    metrics.init_app(app)
+    httpcache.init_app(app)
+
+    # Blueprints
+    from app.auth import bp as auth_bp  # noqa: F402,F401
+
+    app.register_blueprint(auth_bp, url_prefix="/auth")
+
+    from app.errors import bp as errors_bp  # noqa: F402,F401
+
+    app.register_blueprint(errors_bp)
+
+    from app.main import bp as main_bp  # noqa: F402,F401
+
+    app.register_blueprint(main_bp)
+
+    from app.api import bp as api_bp  # noqa: F402,F401
+
+    app.register_blueprint(api_bp, url_prefix="/api")
+
+    if app.config["TEMPLATE_WARMUP"]:
+        templating.warm_up(app)
+
+
 from app import models  # noqa: F402,F401
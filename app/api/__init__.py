@@ -1,5 +1,16 @@
-from flask import Blueprint
+from flask import Blueprint, request
+
+from app import fastjson
+from app.database import prefer_replica
 
 bp = Blueprint("api", __name__)
+bp.json_encoder = fastjson.unicode_encoder
+
+
+@bp.before_request
+def route_reads():
+    if request.method == "GET":
+        prefer_replica()
+
 
 from app.api import errors, tokens, users  # noqa: F402,F401
@@ -1,6 +1,6 @@
 from flask import jsonify, request
 
-from app import db
+from app import db, tokencache
 from app.api import bp
 from app.api.auth import basic_auth, token_auth
 
@@ -8,8 +8,11 @@ from app.api.auth import basic_auth, token_auth
 @bp.route("/tokens", methods=["POST"])
 @basic_auth.login_required
 def get_token():
-    token = basic_auth.current_user().get_token()
+    user = basic_auth.current_user()
+    token = user.get_token()
     db.session.commit()
+    # Lets the new token verify before it reaches a read replica
+    tokencache.store(token, user.id, user.token_expiration)
     return jsonify({"token": token})
 
 
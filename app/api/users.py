@@ -1,6 +1,6 @@
-from flask import abort, jsonify, request, url_for
+from flask import abort, current_app, jsonify, request, url_for
 
-from app import db
+from app import db, httpcache
 from app.api import bp, errors
 from app.api.auth import token_auth
 from app.models import User
@@ -10,18 +10,45 @@ from app.models import User
 @token_auth.login_required
 def get_user(id):
     """Return a user."""
-    return jsonify(User.query.get_or_404(id).to_dict())
+    user = User.query.get_or_404(id)
+    # No Last-Modified: no column records when everything in to_dict() changed
+    return httpcache.conditional(
+        lambda: jsonify(user.to_dict()), httpcache.etag(user.version)
+    )
+
+
+def _collection(query, endpoint, **kwargs):
+    """Return a page of users, or a 304 if the client's copy is current.
+
+    Collections are paged with ?per_page= and the ?cursor= of their next and
+    prev _links; the ?page= parameter and the "page" meta field are gone. The
+    totals in _meta are only counted with ?include_total=1. An invalid cursor
+    is a 404.
+    """
+    cursor = request.args.get("cursor")
+    per_page = min(request.args.get("per_page", 10, type=int), 100)
+    include_total = request.args.get("include_total", 0, type=int) == 1
+
+    resources = User.collection_page(query, cursor, per_page, include_total)
+    return httpcache.conditional(
+        lambda: User.page_to_collection_dict(
+            resources, cursor, per_page, endpoint, **kwargs
+        ),
+        httpcache.etag(
+            request.full_path,
+            resources.total,
+            resources.next_cursor,
+            resources.prev_cursor,
+            [user.version for user in resources.items],
+        ),
+    )
 
 
 @bp.route("users", methods=["GET"])
 @token_auth.login_required
 def get_users():
     """Return all users."""
-    page = request.args.get("page", type=int)
-    per_page = min(request.args.get("per_page", 10, type=int), 100)
-
-    data = User.to_collection_dict(User.query, page, per_page, "api.get_users")
-    return data
+    return _collection(User.query, "api.get_users")
 
 
 @bp.route("users/<int:id>/followers", methods=["GET"])
@@ -29,13 +56,7 @@ def get_users():
 def get_followers(id):
     """Return followers of a specific user."""
     user = User.query.get_or_404(id)
-    page = request.args.get("page", type=int)
-    per_page = min(request.args.get("per_page", 10, type=int), 100)
-
-    data = User.to_collection_dict(
-        user.followers, page, per_page, "api.get_followers", id=id
-    )
-    return data
+    return _collection(user.followers, "api.get_followers", id=id)
 
 
 @bp.route("users/<int:id>/followed", methods=["GET"])
@@ -43,13 +64,44 @@ def get_followers(id):
 def get_followed(id):
     """Return the users followed by a specific user."""
     user = User.query.get_or_404(id)
-    page = request.args.get("page", type=int)
-    per_page = min(request.args.get("per_page", 10, type=int), 100)
+    return _collection(user.followed, "api.get_followed", id=id)
+
+
+@bp.route("users/<int:id>/followed", methods=["POST"])
+@token_auth.login_required
+def update_followed(id):
+    """Follow and unfollow many users in a single request."""
+    if token_auth.current_user().id != id:
+        abort(403)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return errors.bad_request("The request body must be a JSON object.")
+    follow = data.get("follow", [])
+    unfollow = data.get("unfollow", [])
+
+    # Sanity checks
+    if not isinstance(follow, list) or not isinstance(unfollow, list):
+        return errors.bad_request("follow and unfollow must be lists of user ids.")
+    # JSON true and false decode to bool, which is an int subclass
+    if not all(
+        isinstance(i, int) and not isinstance(i, bool) for i in follow + unfollow
+    ):
+        return errors.bad_request("follow and unfollow must be lists of user ids.")
+    limit = current_app.config["FOLLOW_BATCH_SIZE"]
+    if len(follow) + len(unfollow) > limit:
+        return errors.bad_request(f"At most {limit} users can be changed at once.")
+
+    followed = User.follow_many((id, other) for other in follow)
+    unfollowed = User.unfollow_many((id, other) for other in unfollow)
+    db.session.commit()
 
-    data = User.to_collection_dict(
-        user.followed, page, per_page, "api.get_followers", id=id
+    return jsonify(
+        {
+            "followed": [other for _, other in followed],
+            "unfollowed": [other for _, other in unfollowed],
+        }
     )
-    return data
 
 
 @bp.route("users", methods=["POST"])
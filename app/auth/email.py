@@ -1,14 +1,62 @@
-from threading import Thread
+import pickle
+import smtplib
+import time
 
 from flask_mail import Message
 from flask import current_app, render_template
+import redis
 
 from app import mail
 
+OUTBOX_KEY = "mail:outbox"
+FLUSH_KEY = "mail:flush-queued"
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+
+def deliver(messages):
+    """Send messages over one SMTP connection, retrying with exponential backoff.
+
+    After a connection or server error the remaining messages are resent over a
+    new connection. Messages the server rejects permanently (a 5xx reply, or
+    every recipient refused) are logged and dropped. Returns the messages that
+    could not be sent.
+    """
+    pending = list(messages)
+    retries = current_app.config["MAIL_RETRIES"]
+    for attempt in range(retries + 1):
+        try:
+            with mail.connect() as conn:
+                while pending:
+                    try:
+                        conn.send(pending[0])
+                    except smtplib.SMTPException as e:
+                        if not _rejected(e):
+                            raise
+                        current_app.logger.error(
+                            f"Email to {pending[0].recipients} refused", exc_info=True
+                        )
+                    pending.pop(0)
+            return []
+        except (smtplib.SMTPException, OSError):
+            if not pending:
+                # Everything went out; only closing the connection failed
+                return []
+            if attempt == retries:
+                break
+            current_app.logger.warning(
+                f"Could not send email, retrying (attempt {attempt + 1})",
+                exc_info=True,
+            )
+            time.sleep(current_app.config["MAIL_BACKOFF"] * 2 ** attempt)
+
+    current_app.logger.error(f"Gave up sending {len(pending)} emails")
+    return pending
+
+
+def _rejected(exc):
+    """Tell whether exc rejects the message being sent rather than the connection."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code >= 500
 
 
 def send_email(
@@ -22,12 +70,56 @@ def send_email(
         for attachment in attachments:
             msg.attach(*attachment)
 
-    if sync:
-        mail.send(msg)
-    else:
-        Thread(
-            target=send_async_email, args=(current_app.get_current_object(), msg)
-        ).start()
+    if sync or not current_app.config["MAIL_ASYNC"]:
+        deliver([msg])
+        return None
+
+    try:
+        queue_email(msg)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning("Could not queue email, sending it now")
+        deliver([msg])
+
+
+def queue_email(msg):
+    """Add a message to the outbox, and queue a job to send it unless one is.
+
+    A single job sends everything that reaches the outbox before it runs, over
+    one SMTP connection.
+    """
+    current_app.redis.rpush(OUTBOX_KEY, pickle.dumps(msg))
+    try:
+        # The flag expires in case the job is lost, so the outbox is never stuck
+        ttl = current_app.config["MAIL_FLUSH_TIMEOUT"]
+        if current_app.redis.set(FLUSH_KEY, 1, nx=True, ex=ttl):
+            current_app.task_queue.enqueue("app.tasks.send_emails")
+    except redis.exceptions.RedisError:
+        current_app.logger.warning(
+            "Could not queue the email job; the next email will", exc_info=True
+        )
+
+
+def take_queued_emails():
+    """Empty the outbox and return its messages."""
+    # Clear the flag first, so that messages added from now on queue a new job
+    current_app.redis.delete(FLUSH_KEY)
+    pipe = current_app.redis.pipeline()
+    pipe.lrange(OUTBOX_KEY, 0, -1)
+    pipe.delete(OUTBOX_KEY)
+    queued, _ = pipe.execute()
+    return [pickle.loads(data) for data in queued]
+
+
+def requeue_emails(messages):
+    """Put messages that could not be sent back at the head of the outbox.
+
+    No job is queued for them, so that an SMTP outage does not turn into a loop
+    of failing jobs; the job queued by the next email sends them first.
+    """
+    if messages:
+        current_app.redis.lpush(
+            OUTBOX_KEY, *[pickle.dumps(msg) for msg in reversed(messages)]
+        )
 
 
 def send_password_reset_email(user):
@@ -1,7 +1,11 @@
+import csv
+import itertools
 import os
 
 import click
 
+from app import PROFILES
+
 
 def register(app):
     @app.cli.group()
@@ -32,3 +36,160 @@ def register(app):
     def compile():
         if os.system("pybabel compile -d app/translations"):
             raise RuntimeError("compile command failed")
+
+    @app.cli.group()
+    def templates():
+        """Template commands."""
+        pass
+
+    @templates.command("compile")
+    def compile_templates():
+        """Compile every template into TEMPLATE_CACHE_DIR."""
+        from app import templating
+
+        if not app.config["TEMPLATE_CACHE_DIR"]:
+            raise click.UsageError("TEMPLATE_CACHE_DIR is not set")
+        click.echo(f"Compiled {templating.warm_up(app)} templates")
+
+    @app.cli.command("profile-startup")
+    @click.option("--profile", type=click.Choice(PROFILES), default="web")
+    @click.option("--limit", default=20, help="Packages to list.")
+    def profile_startup(profile, limit):
+        """Report where a cold start's time goes, per imported package."""
+        from app import startup
+
+        imports, setup, packages = startup.profile(app, profile)
+        click.echo(f"import app:   {imports * 1000:8.1f} ms")
+        click.echo(f"create_app(): {setup * 1000:8.1f} ms")
+        click.echo()
+        for package, microseconds in packages.most_common(limit):
+            click.echo(f"{microseconds / 1000:8.1f} ms  {package}")
+
+    @app.cli.group()
+    def timeline():
+        """Materialized home timeline commands."""
+        pass
+
+    @timeline.command()
+    @click.argument("usernames", nargs=-1)
+    def rebuild(usernames):
+        """Rebuild the Redis timelines of the given users (default: all)."""
+        from app.models import User
+
+        query = User.query
+        if usernames:
+            query = query.filter(User.username.in_(usernames))
+        for user in query.yield_per(100):
+            user.rebuild_timeline()
+
+    @app.cli.group()
+    def counters():
+        """Denormalized user counter commands."""
+        pass
+
+    @counters.command()
+    @click.option("--batch-size", default=500, help="Users per transaction.")
+    @click.option("--queue", is_flag=True, help="Run as a background RQ job.")
+    def repair(batch_size, queue):
+        """Recompute post, follower, followed and unread counters; fix any drift."""
+        from app.models import User
+
+        if queue:
+            job = app.task_queue.enqueue(
+                "app.tasks.repair_counters", batch_size=batch_size
+            )
+            click.echo(f"Enqueued job {job.get_id()}")
+        else:
+            repaired = User.repair_counts(batch_size=batch_size)
+            click.echo(f"Repaired counters of {repaired} users")
+
+    @app.cli.group()
+    def notifications():
+        """Notification store commands."""
+        pass
+
+    @notifications.command()
+    @click.option("--batch-size", default=1000, help="Rows per transaction.")
+    @click.option("--queue", is_flag=True, help="Run as a background RQ job.")
+    def purge(batch_size, queue):
+        """Delete notifications older than NOTIFICATION_TTL seconds."""
+        from app.models import Notification
+
+        if queue:
+            job = app.task_queue.enqueue(
+                "app.tasks.purge_notifications", batch_size=batch_size
+            )
+            click.echo(f"Enqueued job {job.get_id()}")
+        else:
+            purged = Notification.purge_expired(
+                app.config["NOTIFICATION_TTL"], batch_size=batch_size
+            )
+            click.echo(f"Purged {purged} expired notifications")
+
+    @app.cli.group()
+    def exports():
+        """Post export file commands."""
+        pass
+
+    @exports.command("purge")
+    @click.option("--queue", is_flag=True, help="Run as a background RQ job.")
+    def purge_exports(queue):
+        """Delete export files older than EXPORT_TTL seconds."""
+        from app.models import Task
+
+        if queue:
+            job = app.task_queue.enqueue("app.tasks.purge_exports")
+            click.echo(f"Enqueued job {job.get_id()}")
+        else:
+            purged = Task.purge_exports(app.config["EXPORT_TTL"])
+            click.echo(f"Purged {purged} expired exports")
+
+    @app.cli.group()
+    def follows():
+        """Follower graph commands."""
+        pass
+
+    @follows.command("import")
+    @click.argument("file", type=click.File())
+    @click.option("--unfollow", is_flag=True, help="Remove the edges instead.")
+    @click.option(
+        "--batch-size",
+        default=app.config["FOLLOW_BATCH_SIZE"],
+        help="Pairs per transaction.",
+    )
+    def import_follows(file, unfollow, batch_size):
+        """Import follower_id,followed_id pairs from a CSV file."""
+        from app import db
+        from app.models import User
+
+        bulk = User.unfollow_many if unfollow else User.follow_many
+        reader = csv.reader(file)
+        changed = 0
+        while True:
+            rows = list(itertools.islice(reader, batch_size))
+            if not rows:
+                break
+            pairs = [(int(a), int(b)) for a, b, *_ in rows if a.strip().isdigit()]
+            changed += len(bulk(pairs))
+            db.session.commit()
+        click.echo(f"{'Removed' if unfollow else 'Added'} {changed} follow edges")
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command()
+    @click.option("--batch-size", default=500, help="Documents per bulk request.")
+    def reindex(batch_size):
+        """Rebuild the search index of every searchable model."""
+        from app.models import Post
+
+        Post.reindex(batch_size=batch_size)
+
+    @search.command()
+    def requeue():
+        """Retry index actions that were dead-lettered."""
+        from app.search import requeue_dead_letters
+
+        click.echo(f"Requeued {requeue_dead_letters()} actions")
@@ -0,0 +1,58 @@
+"""Negotiated gzip/brotli compression of buffered responses.
+
+Streamed and passthrough responses (Server-Sent Events, file downloads) are
+left alone, as are bodies under COMPRESS_MIN_SIZE bytes and mimetypes outside
+COMPRESS_MIMETYPES. Brotli is offered only when the Brotli package is
+installed. Compressed responses get a weak ETag, which still matches the
+strong one in conditional requests.
+"""
+import gzip
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _encodings():
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def _compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=current_app.config["COMPRESS_BR_QUALITY"])
+    return gzip.compress(data, compresslevel=current_app.config["COMPRESS_LEVEL"])
+
+
+def _compress_response(response):
+    config = current_app.config
+    if response.mimetype not in config["COMPRESS_MIMETYPES"]:
+        return response
+    if response.direct_passthrough or response.is_streamed:
+        return response
+    response.vary.add("Accept-Encoding")
+
+    if (
+        not 200 <= response.status_code < 300
+        or response.status_code == 204
+        or "Content-Encoding" in response.headers
+        or (response.content_length or 0) < config["COMPRESS_MIN_SIZE"]
+    ):
+        return response
+
+    encoding = request.accept_encodings.best_match(_encodings())
+    if encoding is None:
+        return response
+
+    response.set_data(_compress(response.get_data(), encoding))
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    app.after_request(_compress_response)
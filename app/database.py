@@ -0,0 +1,89 @@
+"""Connection pool settings and read-replica routing for Flask-SQLAlchemy.
+
+With a "replica" entry in SQLALCHEMY_BINDS, reads made by views marked with
+read_only() go to the replica. Flushes, every other view, and any request made
+within REPLICA_STICKY_SECONDS of the same browser session committing use the
+primary, so users always read their own writes despite replication lag.
+"""
+from functools import wraps
+import time
+
+from flask import current_app, g, has_request_context, session as cookie_session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+
+REPLICA = "replica"
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and _reads_from_replica(self.app):
+            state = self.app.extensions["sqlalchemy"]
+            return state.db.get_engine(self.app, bind=REPLICA)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        # Listen on the class the sessionmaker creates; listeners added to
+        # RoutingSession itself do not reach it
+        event.listen(factory, "after_commit", _record_commit)
+        return factory
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # Flask-SQLAlchemy 2.4 updates options in place and returns nothing,
+        # 2.5 returns the URL and options
+        rv = super().apply_driver_hacks(app, sa_url, options)
+        if rv is not None:
+            sa_url, options = rv
+
+        # SQLite engines use a null or static pool without these options
+        if not sa_url.drivername.startswith("sqlite"):
+            options.setdefault("pool_size", app.config["DATABASE_POOL_SIZE"])
+            options.setdefault("max_overflow", app.config["DATABASE_MAX_OVERFLOW"])
+            options.setdefault("pool_recycle", app.config["DATABASE_POOL_RECYCLE"])
+            options.setdefault("pool_pre_ping", app.config["DATABASE_POOL_PRE_PING"])
+        return rv
+
+
+def _has_replica(app):
+    return REPLICA in (app.config["SQLALCHEMY_BINDS"] or {})
+
+
+def _reads_from_replica(app):
+    if not has_request_context() or not g.get("db_read_only"):
+        return False
+    if g.get("db_committed") or not _has_replica(app):
+        return False
+    return cookie_session.get("db_primary_until", 0) < time.time()
+
+
+def prefer_replica():
+    """Send the reads of the current request to the replica, if configured."""
+    g.db_read_only = True
+
+
+def read_only(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        prefer_replica()
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+def _record_commit(session):
+    if has_request_context():
+        g.db_committed = True
+
+
+def _stick_to_primary(response):
+    if g.get("db_committed") and _has_replica(current_app):
+        sticky = current_app.config["REPLICA_STICKY_SECONDS"]
+        cookie_session["db_primary_until"] = time.time() + sticky
+    return response
+
+
+def init_app(app):
+    app.after_request(_stick_to_primary)
@@ -0,0 +1,48 @@
+"""JSON encoding through orjson, when it is installed.
+
+Flask 1.1 has no pluggable JSON provider, but jsonify(), dict responses and
+the tojson filter all end up calling app.json_encoder().encode(), so that is
+where orjson is swapped in. Pretty printing and ASCII-only output still go
+through the stdlib encoder, which stays the fallback when orjson is missing.
+
+JSON_AS_ASCII stays on, since it also governs the tojson filter used in pages.
+Blueprints that serve only JSON, like the API, opt out with unicode_encoder.
+"""
+from flask import current_app
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ORJSONEncoder(JSONEncoder):
+    def encode(self, o):
+        if self.indent is not None or self.ensure_ascii:
+            return super().encode(o)
+
+        # Datetimes and dataclasses still go through Flask's default() so the
+        # output matches the stdlib encoder's
+        option = (
+            orjson.OPT_NON_STR_KEYS
+            | orjson.OPT_PASSTHROUGH_DATETIME
+            | orjson.OPT_PASSTHROUGH_DATACLASS
+        )
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(o, default=self.default, option=option).decode("utf-8")
+
+
+def unicode_encoder(**kwargs):
+    """Build the app's JSON encoder with non-ASCII characters written as is.
+
+    Meant as a blueprint's json_encoder; Flask calls it like an encoder class.
+    """
+    kwargs["ensure_ascii"] = False
+    return current_app.json_encoder(**kwargs)
+
+
+def init_app(app):
+    if app.config["JSON_BACKEND"] == "orjson" and orjson is not None:
+        app.json_encoder = ORJSONEncoder
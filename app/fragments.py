@@ -0,0 +1,34 @@
+"""In-process cache of rendered post rows.
+
+Rows are keyed by everything that affects their HTML: the row's table and id,
+the viewer's locale and the author's profile version. An edited profile thus
+yields new keys rather than needing invalidation across workers, and the stale
+rows simply age out of the LRU.
+"""
+from collections import OrderedDict
+import threading
+
+from flask import current_app, g, render_template
+from markupsafe import Markup
+
+_local = OrderedDict()
+_lock = threading.Lock()
+
+
+def render_posts(posts):
+    """Return the rendered _post.html row of each post, reusing cached rows."""
+    rows = []
+    for post in posts:
+        key = (post.__tablename__, post.id, g.locale, post.author.profile_version)
+        with _lock:
+            row = _local.get(key)
+            if row is not None:
+                _local.move_to_end(key)
+        if row is None:
+            row = Markup(render_template("_post.html", post=post))
+            with _lock:
+                _local[key] = row
+                while len(_local) > current_app.config["FRAGMENT_CACHE_SIZE"]:
+                    _local.popitem(last=False)
+        rows.append(row)
+    return rows
@@ -0,0 +1,56 @@
+"""Conditional GET support for API resources and pages.
+
+Views pass conditional() a strong ETag, and optionally a Last-Modified time,
+derived from row versions without rendering anything. When the client's copy
+is current the response is a bare 304 and the body is never built. Every
+response also gets its blueprint's CACHE_CONTROL policy unless the view set
+its own.
+"""
+from hashlib import sha1
+
+from flask import current_app, request
+
+
+def etag(*parts):
+    """Return a strong ETag for the given version parts."""
+    return sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def is_fresh(etag, last_modified=None):
+    """Tell whether the client's cached copy matches the given validators."""
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        return request.if_none_match.contains_weak(etag)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def conditional(build, etag, last_modified=None):
+    """Return a 304 if the client is up to date, else build()'s response.
+
+    Either way the response carries the ETag and Last-Modified validators.
+    """
+    if last_modified is not None:
+        # HTTP dates only have whole seconds
+        last_modified = last_modified.replace(microsecond=0)
+
+    if is_fresh(etag, last_modified):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.make_response(build())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def _apply_cache_control(response):
+    policy = current_app.config["CACHE_CONTROL"].get(request.blueprint)
+    if policy and "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = policy
+    return response
+
+
+def init_app(app):
+    app.after_request(_apply_cache_control)
@@ -0,0 +1,331 @@
+"""In-process full-text search engine used when Elasticsearch is not configured.
+
+Each index is one immutable segment file holding a document length table, a
+term dictionary and the postings lists, plus an append-only log of the changes
+made since the segment was written. Segments are memory-mapped, so only the
+dictionaries are loaded up front and postings are read straight from the page
+cache at query time. Writes only append to the log, which every process reads
+incrementally and overlays on the segment; once the log has grown to a fraction
+of the segment, it is merged into a new segment that is atomically swapped in.
+Results are ranked with BM25.
+
+The directory is the only thing processes share, so the web and worker
+processes must all see the same one (e.g. a mounted volume).
+"""
+from collections import defaultdict
+import fcntl
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+
+MAGIC = b"MBSEG\x01"
+HEADER = struct.Struct("<6sIIQ")  # magic, doc count, term count, total length
+DOC = struct.Struct("<qI")  # doc id, length in tokens
+TERM = struct.Struct("<HIQ")  # term byte length, document frequency, offset
+POSTING = struct.Struct("<qI")  # doc id, term frequency
+
+K1 = 1.2
+B = 0.75
+
+# The log is merged once it holds this many changes or MERGE_RATIO times the
+# segment's document count, whichever is larger, so merging stays amortised
+MERGE_MIN_CHANGES = 1000
+MERGE_RATIO = 0.1
+
+_token_re = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _token_re.findall(text.lower())
+
+
+class Segment:
+    """A read-only, memory-mapped index segment."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        magic, doc_count, term_count, self.total_length = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a search segment")
+
+        offset = HEADER.size
+        self.doc_lengths = dict(
+            DOC.iter_unpack(self._view[offset : offset + doc_count * DOC.size])
+        )
+        offset += doc_count * DOC.size
+
+        self._terms = {}
+        for _ in range(term_count):
+            length, df, postings = TERM.unpack_from(self._mmap, offset)
+            offset += TERM.size
+            term = bytes(self._view[offset : offset + length]).decode("utf-8")
+            self._terms[term] = (df, postings)
+            offset += length
+
+    def postings(self, term):
+        """Return (doc_id, term_frequency) pairs for term."""
+        if term not in self._terms:
+            return []
+        df, offset = self._terms[term]
+        return POSTING.iter_unpack(self._view[offset : offset + df * POSTING.size])
+
+    def load(self):
+        """Return mutable copies of the document lengths and postings."""
+        postings = {term: dict(self.postings(term)) for term in self._terms}
+        return dict(self.doc_lengths), postings
+
+
+def write_segment(path, doc_lengths, postings):
+    terms = [(term.encode("utf-8"), postings[term]) for term in sorted(postings)]
+    offset = (
+        HEADER.size
+        + len(doc_lengths) * DOC.size
+        + sum(TERM.size + len(term) for term, _ in terms)
+    )
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(
+            HEADER.pack(MAGIC, len(doc_lengths), len(terms), sum(doc_lengths.values()))
+        )
+        for doc_id in sorted(doc_lengths):
+            f.write(DOC.pack(doc_id, doc_lengths[doc_id]))
+        for term, docs in terms:
+            f.write(TERM.pack(len(term), len(docs), offset))
+            f.write(term)
+            offset += len(docs) * POSTING.size
+        for _, docs in terms:
+            for doc_id in sorted(docs):
+                f.write(POSTING.pack(doc_id, docs[doc_id]))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Delta:
+    """The changes read from an index's log, overlaid on the segment it follows.
+
+    doc_lengths maps every changed document to its new length, or to None if
+    it was deleted; those documents' entries in the segment are stale.
+    """
+
+    def __init__(self, base=None, inode=None):
+        self.base = base
+        self.inode = inode
+        self.offset = 0
+        self.changes = 0
+        self.doc_lengths = {}
+        self.postings = {}
+        self._doc_terms = {}
+        self._stats = None
+
+    def apply(self, change):
+        doc_id = change["id"]
+        for term in self._doc_terms.pop(doc_id, ()):
+            docs = self.postings[term]
+            del docs[doc_id]
+            if not docs:
+                del self.postings[term]
+
+        if change["op"] == "index":
+            self.doc_lengths[doc_id] = change["length"]
+            self._doc_terms[doc_id] = list(change["terms"])
+            for term, tf in change["terms"].items():
+                self.postings.setdefault(term, {})[doc_id] = tf
+        else:
+            self.doc_lengths[doc_id] = None
+        self.changes += 1
+        self._stats = None
+
+    def corpus_stats(self, segment):
+        """Return the document count and total length of segment and changes."""
+        if self._stats is None:
+            doc_lengths = segment.doc_lengths if segment else {}
+            doc_count = len(doc_lengths)
+            total_length = segment.total_length if segment else 0
+            for doc_id, length in self.doc_lengths.items():
+                if doc_id in doc_lengths:
+                    doc_count -= 1
+                    total_length -= doc_lengths[doc_id]
+                if length is not None:
+                    doc_count += 1
+                    total_length += length
+            self._stats = (doc_count, total_length)
+        return self._stats
+
+
+def log_entry(action):
+    """Return the log line recording an index or delete action."""
+    change = {"op": action["op"], "id": action["id"]}
+    if action["op"] == "index":
+        text = " ".join(str(v) for v in action["doc"].values() if v)
+        tokens = tokenize(text)
+        terms = defaultdict(int)
+        for token in tokens:
+            terms[token] += 1
+        change.update(length=len(tokens), terms=terms)
+    return json.dumps(change).encode("utf-8") + b"\n"
+
+
+class LocalSearchBackend:
+    """Search backend that keeps a memory-mapped segment and a log per index."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._segments = {}
+        self._deltas = {}
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".seg"):
+                self._segment(name[: -len(".seg")])
+
+    def _path(self, index, extension="seg"):
+        return os.path.join(self.directory, f"{index}.{extension}")
+
+    def _segment(self, index):
+        """Return the index's segment and its version, or None for both."""
+        try:
+            stat = os.stat(self._path(index))
+        except FileNotFoundError:
+            self._segments.pop(index, None)
+            return None, None
+
+        # Writers swap in a new file, so a changed inode means a new segment
+        version = (stat.st_ino, stat.st_mtime_ns)
+        cached = self._segments.get(index)
+        if cached is None or cached[0] != version:
+            cached = (version, Segment(self._path(index)))
+            self._segments[index] = cached
+        return cached[1], version
+
+    def _delta(self, index, base):
+        """Return the log following segment version base.
+
+        Only what was appended since the last call is read.
+        """
+        try:
+            f = open(self._path(index, "log"), "rb")
+        except FileNotFoundError:
+            self._deltas.pop(index, None)
+            return Delta(base)
+
+        with f:
+            stat = os.fstat(f.fileno())
+            delta = self._deltas.get(index)
+            # A merge writes a new segment and starts a new log
+            if delta is None or (delta.base, delta.inode) != (base, stat.st_ino):
+                delta = self._deltas[index] = Delta(base, stat.st_ino)
+            if stat.st_size > delta.offset:
+                f.seek(delta.offset)
+                data = f.read(stat.st_size - delta.offset)
+                # Leave a line that is still being written for the next read
+                end = data.rfind(b"\n") + 1
+                for line in data[:end].splitlines():
+                    try:
+                        delta.apply(json.loads(line))
+                    except ValueError:
+                        continue
+                delta.offset += end
+        return delta
+
+    def _snapshot(self, index):
+        """Return the index's segment and the log that follows it."""
+        while True:
+            segment, version = self._segment(index)
+            delta = self._delta(index, version)
+            # Read both again if a merge swapped in a new segment meanwhile
+            if self._segment(index)[1] == version:
+                return segment, delta
+
+    def apply(self, actions):
+        by_index = defaultdict(list)
+        for action in actions:
+            by_index[action["index"]].append(action)
+
+        failed = []
+        for index, index_actions in by_index.items():
+            try:
+                self._apply(index, index_actions)
+            except OSError:
+                failed.extend(index_actions)
+        return failed
+
+    def _apply(self, index, actions):
+        with open(self._path(index, "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self._path(index, "log"), "ab") as f:
+                f.write(b"".join(log_entry(action) for action in actions))
+                f.flush()
+                os.fsync(f.fileno())
+
+            segment, delta = self._snapshot(index)
+            size = len(segment.doc_lengths) if segment else 0
+            if delta.changes >= max(MERGE_MIN_CHANGES, MERGE_RATIO * size):
+                self._merge(index, segment, delta)
+
+    def merge(self, index):
+        """Fold the index's log into a new segment."""
+        with open(self._path(index, "lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            segment, delta = self._snapshot(index)
+            if delta.changes:
+                self._merge(index, segment, delta)
+
+    def _merge(self, index, segment, delta):
+        doc_lengths, postings = segment.load() if segment else ({}, {})
+        for term in list(postings):
+            docs = postings[term]
+            for doc_id in docs.keys() & delta.doc_lengths.keys():
+                del docs[doc_id]
+            if not docs:
+                del postings[term]
+        for doc_id, length in delta.doc_lengths.items():
+            if length is None:
+                doc_lengths.pop(doc_id, None)
+            else:
+                doc_lengths[doc_id] = length
+        for term, docs in delta.postings.items():
+            postings.setdefault(term, {}).update(docs)
+
+        write_segment(self._path(index), doc_lengths, postings)
+        os.remove(self._path(index, "log"))
+        self._deltas.pop(index, None)
+
+    def query(self, index, query, page, per_page):
+        segment, delta = self._snapshot(index)
+        terms = set(tokenize(query))
+        doc_count, total_length = delta.corpus_stats(segment)
+        if not terms or not doc_count:
+            return [], 0
+
+        changed = delta.doc_lengths
+        doc_lengths = segment.doc_lengths if segment else {}
+        average_length = total_length / doc_count or 1
+        scores = defaultdict(float)
+        for term in terms:
+            matches = list(delta.postings.get(term, {}).items())
+            if segment:
+                matches.extend(
+                    (doc_id, tf)
+                    for doc_id, tf in segment.postings(term)
+                    if doc_id not in changed
+                )
+            df = len(matches)
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            for doc_id, tf in matches:
+                length = changed[doc_id] if doc_id in changed else doc_lengths[doc_id]
+                norm = 1 - B + B * length / average_length
+                scores[doc_id] += idf * tf * (K1 + 1) / (tf + K1 * norm)
+
+        # Equal scores rank newer (higher id) documents first
+        ranked = heapq.nlargest(
+            page * per_page, scores, key=lambda doc_id: (scores[doc_id], doc_id)
+        )
+        return ranked[(page - 1) * per_page :], len(scores)
@@ -1,6 +1,9 @@
 from datetime import datetime
+import os
+import time
 
 from flask import (
+    abort,
     current_app,
     flash,
     g,
@@ -8,13 +11,18 @@ from flask import (
     redirect,
     render_template,
     request,
+    Response,
+    send_file,
+    session,
     url_for,
 )
 from flask_babel import _, get_locale
 from flask_login import current_user, login_required
 from guess_language import guess_language
+import redis
 
-from app import db
+from app import db, httpcache, streaming, timeline
+from app.database import read_only
 from app.main import bp
 from app.main.forms import (
     EditProfileForm,
@@ -23,19 +31,38 @@ from app.main.forms import (
     PostForm,
     SearchForm,
 )
-from app.models import Message, Notification, Post, User
-from app.translate import translate
+from app.models import Message, Notification, Post, Task, User
+from app.pagination import paginate
+from app.translate import translate, translate_many, TranslationError
 
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        current_user.ping()
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
+def _page_is_cacheable():
+    """Pages showing flashed messages or task progress are always rendered."""
+    if "_flashes" in session:
+        return False
+    return not (current_user.is_authenticated and current_user.get_tasks_in_progress())
+
+
+def _viewer_version():
+    """Changes whenever the viewer-specific parts of base.html change."""
+    if not current_user.is_authenticated:
+        return (g.locale,)
+    return (
+        g.locale,
+        current_user.id,
+        current_user.username,
+        current_user.unread_message_count,
+    )
+
+
 @bp.route("/", methods=["GET", "POST"])
 @bp.route("/index", methods=["GET", "POST"])
 @login_required
@@ -58,13 +85,26 @@ def index():
             url_for("main.index")
         )  # Better Refresh behaviour (POST/REDIRECT/GET). Also avoids duplicate posts
 
-    page = request.args.get("page", 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page, current_app.config["POSTS_PER_PAGE"], False
-    )
+    cursor = request.args.get("cursor")
+    per_page = current_app.config["POSTS_PER_PAGE"]
+    posts = current_user.timeline_page(cursor, per_page)
+    if posts is None:
+        # Cold or evicted timeline: serve from SQL and warm the cache
+        posts = paginate(
+            current_user.followed_posts().options(db.joinedload(Post.author)),
+            [Post.timestamp, Post.id],
+            cursor,
+            per_page,
+        )
+        if cursor is None and timeline.enabled():
+            current_user.rebuild_timeline()
 
-    next_url = url_for("main.index", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("main.index", page=posts.prev_num) if posts.has_prev else None
+    next_url = (
+        url_for("main.index", cursor=posts.next_cursor) if posts.has_next else None
+    )
+    prev_url = (
+        url_for("main.index", cursor=posts.prev_cursor) if posts.has_prev else None
+    )
 
     return render_template(
         "index.html",
@@ -77,25 +117,46 @@ def index():
 
 
 @bp.route("/explore")
+@read_only
 def explore():
-    page = request.args.get("page", 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config["POSTS_PER_PAGE"], False
+    posts = paginate(
+        Post.query.options(db.joinedload(Post.author)),
+        [Post.timestamp, Post.id],
+        request.args.get("cursor"),
+        current_app.config["POSTS_PER_PAGE"],
+    )
+    next_url = (
+        url_for("main.explore", cursor=posts.next_cursor) if posts.has_next else None
+    )
+    prev_url = (
+        url_for("main.explore", cursor=posts.prev_cursor) if posts.has_prev else None
     )
-    next_url = url_for("main.explore", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("main.explore", page=posts.prev_num) if posts.has_prev else None
 
-    return render_template(
-        "index.html",
-        title="Explore",
-        posts=posts.items,
-        next_url=next_url,
-        prev_url=prev_url,
+    def build():
+        return render_template(
+            "index.html",
+            title="Explore",
+            posts=posts.items,
+            next_url=next_url,
+            prev_url=prev_url,
+        )
+
+    if not _page_is_cacheable():
+        return build()
+    return httpcache.conditional(
+        build,
+        httpcache.etag(
+            _viewer_version(),
+            next_url,
+            prev_url,
+            [(post.id, post.author.profile_version) for post in posts.items],
+        ),
     )
 
 
 @bp.route("/search")
 @login_required
+@read_only
 def search():
     if not g.search_form.validate():
         return redirect(url_for("main.explore"))
@@ -108,16 +169,16 @@ def search():
     )
 
     next_url = (
-        url_for("app.search", q=query, page=page + 1)
+        url_for("main.search", q=query, page=page + 1)
         if total > page * current_app.config["POSTS_PER_PAGE"]
         else None
     )
-    prev_url = url_for("app.search", q=query, page=page - 1) if page > 1 else None
+    prev_url = url_for("main.search", q=query, page=page - 1) if page > 1 else None
 
     return render_template(
         "search.html",
         title=_("Search"),
-        posts=posts,
+        posts=posts.options(db.joinedload(Post.author)).all(),
         next_url=next_url,
         prev_url=prev_url,
     )
@@ -138,24 +199,63 @@ def notifications():
     )
 
 
+@bp.route("/notifications/stream")
+@login_required
+def notification_stream():
+    if not current_app.config["NOTIFICATION_STREAMING"]:
+        abort(404)
+    since = request.headers.get(
+        "Last-Event-ID", request.args.get("since", 0.0, type=float), type=float
+    )
+    try:
+        # Subscribe before reading the backlog so no notification slips between
+        pubsub = streaming.subscribe(current_user.id)
+    except redis.exceptions.RedisError:
+        abort(503)
+
+    backlog = [
+        streaming.format_event(n.name, n.get_payload(), n.timestamp)
+        for n in current_user.notifications.filter(
+            Notification.timestamp > since
+        ).order_by(Notification.timestamp.asc())
+    ]
+    # Release the database connection for the lifetime of the stream
+    db.session.close()
+
+    return Response(
+        streaming.stream(
+            pubsub,
+            backlog,
+            current_app.config["NOTIFICATION_STREAM_TIMEOUT"],
+            current_app.config["NOTIFICATION_HEARTBEAT"],
+        ),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @bp.route("/messages")
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
-    current_user.add_notification("unread_message_count", 0)
+    current_user.read_messages()
     db.session.commit()
 
-    page = request.args.get("page", 1, type=int)
-
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()
-    ).paginate(page, current_app.config["POSTS_PER_PAGE"], False)
+    messages = paginate(
+        current_user.messages_received.options(db.joinedload(Message.author)),
+        [Message.timestamp, Message.id],
+        request.args.get("cursor"),
+        current_app.config["POSTS_PER_PAGE"],
+    )
 
     next_url = (
-        url_for("main.messages", page=messages.next_num) if messages.has_next else None
+        url_for("main.messages", cursor=messages.next_cursor)
+        if messages.has_next
+        else None
     )
     prev_url = (
-        url_for("main.messages", page=messages.prev_num) if messages.has_prev else None
+        url_for("main.messages", cursor=messages.prev_cursor)
+        if messages.has_prev
+        else None
     )
 
     return render_template(
@@ -171,7 +271,7 @@ def send_message(recipient):
     if form.validate_on_submit():
         message = Message(author=current_user, recipient=user, body=form.message.data)
         db.session.add(message)
-        user.add_notification("unread_message_count", user.new_messages())
+        user.receive_message()
         db.session.commit()
         flash(_("Your message has been sent"))
         return redirect(url_for("main.user", username=recipient))
@@ -182,27 +282,55 @@ def send_message(recipient):
 
 @bp.route("/translate", methods=["POST"])
 def translate_text():
-    return jsonify(
-        {"text": translate(request.form["text"], request.form["target_language"])}
-    )
+    try:
+        text = translate(request.form["text"], request.form["target_language"])
+    except TranslationError as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"text": text})
+
+
+@bp.route("/translate/batch", methods=["POST"])
+def translate_batch():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+    texts, target_language = data.get("texts"), data.get("target_language")
+    config = current_app.config
+    if (
+        not isinstance(texts, list)
+        or len(texts) > config["TRANSLATION_BATCH_SIZE"]
+        or not all(isinstance(text, str) for text in texts)
+        or any(len(text) > config["TRANSLATION_MAX_LENGTH"] for text in texts)
+        or target_language not in config["LANGUAGES"]
+    ):
+        abort(400)
+
+    try:
+        texts = translate_many(texts, target_language)
+    except TranslationError as e:
+        return jsonify({"error": str(e)}), 503
+    return jsonify({"texts": texts})
 
 
 @bp.route("/users/<username>")
 @login_required
+@read_only
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get("page", 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config["POSTS_PER_PAGE"], False
+    posts = paginate(
+        user.posts,
+        [Post.timestamp, Post.id],
+        request.args.get("cursor"),
+        current_app.config["POSTS_PER_PAGE"],
     )
 
     next_url = (
-        url_for("main.user", username=username, page=posts.next_num)
+        url_for("main.user", username=username, cursor=posts.next_cursor)
         if posts.has_next
         else None
     )
     prev_url = (
-        url_for("main.user", username=username, page=posts.prev_num)
+        url_for("main.user", username=username, cursor=posts.prev_cursor)
         if posts.has_prev
         else None
     )
@@ -220,10 +348,23 @@ def user(username):
 
 @bp.route("/users/<username>/popup")
 @login_required
+@read_only
 def user_popup(username):
     user = User.query.filter_by(username=username).first_or_404()
     form = EmptyForm()
-    return render_template("user_popup.html", user=user, form=form)
+    # The follow form embeds a CSRF token; renew it well before it expires
+    limit = current_app.config.get("WTF_CSRF_TIME_LIMIT", 3600)
+    csrf_epoch = int(time.time()) // (limit // 2) if limit else None
+    return httpcache.conditional(
+        lambda: render_template("user_popup.html", user=user, form=form),
+        httpcache.etag(
+            _viewer_version(),
+            session.get("csrf_token"),
+            csrf_epoch,
+            user.version,
+            user != current_user and current_user.is_following(user),
+        ),
+    )
 
 
 @bp.route("/follow/<username>", methods=["POST"])
@@ -288,3 +429,20 @@ def export_posts():
         current_user.launch_task("export_posts", _("Exporting posts"))
         db.session.commit()
     return redirect(url_for("main.user", username=current_user.username))
+
+
+@bp.route("/export_posts/<task_id>")
+@login_required
+def download_export(task_id):
+    task = Task.query.filter_by(
+        id=task_id, user=current_user, name="export_posts", complete=True
+    ).first_or_404()
+    path = task.get_export_path()
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(
+        path,
+        mimetype="application/gzip",
+        as_attachment=True,
+        attachment_filename="posts.ndjson.gz",
+    )
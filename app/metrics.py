@@ -0,0 +1,236 @@
+"""Per-request SQL instrumentation exposed as Prometheus metrics.
+
+SQLAlchemy cursor events time every statement and Flask request signals fold
+each request's statements into per-endpoint histograms. Requests and
+statements over the SLOW_* thresholds are logged through the app logger, and
+with SERVER_TIMING set each response reports its database time to devtools.
+
+Statements are labelled by a fingerprint of their normalized text rather than
+by the SQL itself; the slow query log gives the statement for each fingerprint.
+/metrics only answers clients in METRICS_ALLOWED_IPS or bearing METRICS_TOKEN.
+
+Metrics are kept per process, so under gunicorn every worker serves its own.
+"""
+from hashlib import sha1
+import hmac
+import re
+import threading
+import time
+
+from flask import (
+    abort,
+    current_app,
+    g,
+    has_app_context,
+    request,
+    request_finished,
+    request_started,
+    Response,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import tokencache
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+HISTOGRAMS = {
+    "microblog_request_duration_seconds": (
+        "Time spent handling requests.",
+        DURATION_BUCKETS,
+    ),
+    "microblog_request_db_seconds": (
+        "Time spent executing SQL statements per request.",
+        DURATION_BUCKETS,
+    ),
+    "microblog_request_queries": (
+        "SQL statements executed per request.",
+        QUERY_BUCKETS,
+    ),
+}
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+_lock = threading.Lock()
+_histograms = {name: {} for name in HISTOGRAMS}
+_slowest = {}  # endpoint -> [(seconds, statement)], slowest first
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+def init_app(app):
+    if not event.contains(Engine, "before_cursor_execute", _start_timer):
+        event.listen(Engine, "before_cursor_execute", _start_timer)
+        event.listen(Engine, "after_cursor_execute", _stop_timer)
+        event.listen(Engine, "handle_error", _discard_timer)
+    request_started.connect(_start_request, app)
+    request_finished.connect(_finish_request, app)
+    app.add_url_rule("/metrics", "metrics", metrics)
+
+
+def fingerprint(statement):
+    """Return a short id shared by statements that differ only in their values.
+
+    Literals become placeholders and placeholder lists, such as those of IN
+    clauses, collapse to one.
+    """
+    normalized = " ".join(_LITERALS.sub("?", statement).split())
+    normalized = _LISTS.sub("(?)", normalized.replace("%s", "?"))
+    return sha1(normalized.encode("utf-8")).hexdigest()[:12]
+
+
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _discard_timer(exception_context):
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_start"):
+        conn.info["query_start"].pop()
+
+
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    if not has_app_context():
+        return None
+
+    if elapsed >= current_app.config["SLOW_QUERY_THRESHOLD"]:
+        current_app.logger.warning(
+            f"Slow query {fingerprint(statement)} ({elapsed:.3f}s): {statement}"
+        )
+
+    stats = g.get("sql_stats")
+    if stats is not None:
+        stats["queries"] += 1
+        stats["time"] += elapsed
+        stats["slowest"] = _top(
+            stats["slowest"] + [(elapsed, fingerprint(statement))],
+            current_app.config["METRICS_SLOWEST_STATEMENTS"],
+        )
+
+
+def _top(statements, n):
+    """Return the n slowest distinct statements of (seconds, fingerprint) pairs."""
+    slowest = {}
+    for seconds, statement in statements:
+        slowest[statement] = max(seconds, slowest.get(statement, 0.0))
+    return sorted(
+        ((seconds, statement) for statement, seconds in slowest.items()), reverse=True,
+    )[:n]
+
+
+def _start_request(sender, **extra):
+    g.request_start = time.perf_counter()
+    g.sql_stats = {"queries": 0, "time": 0.0, "slowest": []}
+
+
+def _finish_request(sender, response, **extra):
+    stats = g.pop("sql_stats", None)
+    if stats is None:
+        return None
+    duration = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or "unmatched"
+
+    observations = {
+        "microblog_request_duration_seconds": duration,
+        "microblog_request_db_seconds": stats["time"],
+        "microblog_request_queries": stats["queries"],
+    }
+    with _lock:
+        for name, value in observations.items():
+            histogram = _histograms[name].get(endpoint)
+            if histogram is None:
+                histogram = _histograms[name][endpoint] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+        _slowest[endpoint] = _top(
+            _slowest.get(endpoint, []) + stats["slowest"],
+            current_app.config["METRICS_SLOWEST_STATEMENTS"],
+        )
+
+    config = current_app.config
+    if (
+        duration >= config["SLOW_REQUEST_THRESHOLD"]
+        or stats["queries"] >= config["SLOW_REQUEST_QUERIES"]
+    ):
+        slowest = stats["slowest"][0][1] if stats["slowest"] else None
+        current_app.logger.warning(
+            f"Slow request {request.method} {request.path} ({endpoint}): "
+            f"{duration:.3f}s, {stats['queries']} queries taking "
+            f"{stats['time']:.3f}s; slowest: {slowest}"
+        )
+
+    if config["SERVER_TIMING"]:
+        response.headers["Server-Timing"] = (
+            f'db;dur={stats["time"] * 1000:.1f};desc="{stats["queries"]} queries", '
+            f"app;dur={duration * 1000:.1f}"
+        )
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        for name, (description, buckets) in HISTOGRAMS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} histogram")
+            for endpoint, histogram in sorted(_histograms[name].items()):
+                labels = f'endpoint="{_label(endpoint)}"'
+                for bound, count in zip(buckets, histogram.counts):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+                lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+        name = "microblog_slowest_query_seconds"
+        lines.append(f"# HELP {name} Slowest SQL statements seen per endpoint.")
+        lines.append(f"# TYPE {name} gauge")
+        for endpoint, statements in sorted(_slowest.items()):
+            for seconds, statement in statements:
+                labels = f'endpoint="{_label(endpoint)}",statement="{statement}"'
+                lines.append(f"{name}{{{labels}}} {seconds}")
+
+    token_cache = tokencache.stats()
+    name = "microblog_token_cache_lookups_total"
+    lines.append(f"# HELP {name} API token cache lookups by result.")
+    lines.append(f"# TYPE {name} counter")
+    for result in ("local_hits", "redis_hits", "misses"):
+        lines.append(f'{name}{{result="{result}"}} {token_cache[result]}')
+    name = "microblog_token_cache_size"
+    lines.append(f"# HELP {name} API tokens held in the in-process cache.")
+    lines.append(f"# TYPE {name} gauge")
+    lines.append(f"{name} {token_cache['size']}")
+    return "\n".join(lines) + "\n"
+
+
+def _authorized():
+    config = current_app.config
+    if request.remote_addr in config["METRICS_ALLOWED_IPS"]:
+        return True
+    token = config["METRICS_TOKEN"]
+    auth = request.headers.get("Authorization", "")
+    return bool(token) and hmac.compare_digest(auth, f"Bearer {token}")
+
+
+def metrics():
+    if not _authorized():
+        abort(403)
+    return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -1,7 +1,9 @@
 import base64
+from collections import Counter
 from datetime import datetime, timedelta
+import gzip
 from hashlib import md5
-from time import time
+from time import monotonic, time
 import json
 import jwt
 import os
@@ -9,43 +11,77 @@ import os
 from flask import current_app, url_for
 from flask_login import UserMixin
 import redis
-import rq
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from app import db, login, search
+from app import db, login, pagination, search, streaming, timeline, tokencache
 
 
 @login.user_loader
 def user_loader(id):
-    return User.query.get(int(id))
+    user = User.from_cache(int(id))
+    if user is None:
+        user = User.query.get(int(id))
+        if user is not None:
+            user.store_in_cache()
+    return user
 
 
 followers = db.Table(
     "followers",
-    db.Column("follower_id", db.Integer, db.ForeignKey("user.id")),
-    db.Column("followed_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("follower_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("followed_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    # The primary key serves lookups by follower; this one serves the reverse
+    db.Index("ix_followers_followed_id_follower_id", "followed_id", "follower_id"),
 )
 
 
 class PaginatedAPIMixin:
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        resources = query.paginate(page, per_page, False)
+    @classmethod
+    def to_collection_dict(
+        cls, query, cursor, per_page, endpoint, include_total=False, **kwargs
+    ):
+        resources = cls.collection_page(query, cursor, per_page, include_total)
+        return cls.page_to_collection_dict(
+            resources, cursor, per_page, endpoint, **kwargs
+        )
 
+    @classmethod
+    def collection_page(cls, query, cursor, per_page, include_total=False):
+        return pagination.paginate(
+            query, [cls.id], cursor, per_page, descending=False, count=include_total
+        )
+
+    @classmethod
+    def page_to_collection_dict(cls, resources, cursor, per_page, endpoint, **kwargs):
+        """Return the API representation of a page of resources.
+
+        Pages are addressed by the opaque cursors in _links rather than by
+        number, so _meta has no "page". total_items and total_pages are null
+        unless the total was counted (?include_total=1).
+        """
+        total_pages = None
+        if resources.total is not None:
+            total_pages = -(-resources.total // per_page)
         data = {
-            "items": [item.to_dict() for item in resources.items],
+            "items": cls.to_dict_collection(resources.items),
             "meta": {
-                "page": page,
                 "per_page": per_page,
-                "total_pages": resources.pages,
+                "total_pages": total_pages,
                 "total_items": resources.total,
             },
             "_links": {
-                "self": url_for(endpoint, page=page, per_page=per_page, **kwargs),
-                "next": url_for(endpoint, page=page + 1, per_page=per_page, **kwargs)
+                "self": url_for(endpoint, cursor=cursor, per_page=per_page, **kwargs),
+                "next": url_for(
+                    endpoint, cursor=resources.next_cursor, per_page=per_page, **kwargs
+                )
                 if resources.has_next
                 else None,
-                "prev": url_for(endpoint, page=page - 1, per_page=per_page, **kwargs)
+                "prev": url_for(
+                    endpoint, cursor=resources.prev_cursor, per_page=per_page, **kwargs
+                )
                 if resources.has_prev
                 else None,
             },
@@ -53,6 +89,10 @@ class PaginatedAPIMixin:
 
         return data
 
+    @classmethod
+    def to_dict_collection(cls, items):
+        return [item.to_dict() for item in items]
+
 
 class SearchableMixin:
     @classmethod
@@ -80,21 +120,30 @@ class SearchableMixin:
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes["add"]:
+        actions = []
+        for obj in session._changes["add"] + session._changes["update"]:
             if isinstance(obj, SearchableMixin):
-                search.add_to_index(obj.__tablename__, obj)
-        for obj in session._changes["update"]:
-            if isinstance(obj, SearchableMixin):
-                search.add_to_index(obj.__tablename__, obj)
+                actions.append(search.index_action(obj.__tablename__, obj))
         for obj in session._changes["delete"]:
             if isinstance(obj, SearchableMixin):
-                search.remove_from_index(obj.__tablename__, obj)
+                actions.append(search.delete_action(obj.__tablename__, obj))
         session._changes = None
+        search.enqueue(actions)
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            search.add_to_index(obj.__tablename__, obj)
+    def reindex(cls, batch_size=500):
+        last_id = 0
+        while True:
+            batch = (
+                cls.query.filter(cls.id > last_id)
+                .order_by(cls.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not batch:
+                return None
+            search.bulk([search.index_action(cls.__tablename__, obj) for obj in batch])
+            last_id = batch[-1].id
 
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
@@ -102,6 +151,7 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    avatar_hash = db.Column(db.String(32))
     password_hash = db.Column(db.String(124))
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
@@ -109,6 +159,20 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     token = db.Column(db.String(32), index=True, unique=True)
     token_expiration = db.Column(db.DateTime,)
 
+    # Denormalized counters, kept in step by follow/unfollow, the Post
+    # insert/delete events and receive_message/read_messages.
+    # User.repair_counts() fixes any drift.
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    follower_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+    followed_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+    unread_message_count = db.Column(
+        db.Integer, nullable=False, default=0, server_default="0"
+    )
+
     # Relationships (i.e. data pulled from other tables)
     posts = db.relationship("Post", backref="author", lazy="dynamic")
     tasks = db.relationship("Task", backref="user", lazy="dynamic")
@@ -133,9 +197,14 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
     @staticmethod
     def check_token(token):
+        user_id = tokencache.lookup(token)
+        if user_id is not None:
+            return User.from_cache(user_id) or User.query.get(user_id)
+
         user = User.query.filter_by(token=token).first()
         if not user or user.token_expiration < datetime.utcnow():
             return None
+        tokencache.store(token, user.id, user.token_expiration)
         return user
 
     def get_token(self, expires_in=3600):
@@ -144,23 +213,168 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         if self.token and self.token_expiration > now + timedelta(seconds=60):
             return self.token
 
+        if self.token:
+            _queue_token_invalidation(self.token)
         self.token = base64.b64encode(os.urandom(24)).decode("utf-8")
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
         return self.token
 
     def revoke_token(self):
+        if self.token:
+            _queue_token_invalidation(self.token)
         self.token_expiration = datetime.utcnow() - timedelta(seconds=1)
 
+    @staticmethod
+    def load_counts(ids):
+        """Recompute {id: counts} for the given user ids in four grouped queries."""
+        counts = {
+            id: {
+                "post_count": 0,
+                "follower_count": 0,
+                "followed_count": 0,
+                "unread_message_count": 0,
+            }
+            for id in ids
+        }
+        if not ids:
+            return counts
+
+        queries = {
+            "post_count": db.session.query(Post.user_id, db.func.count(Post.id))
+            .filter(Post.user_id.in_(ids))
+            .group_by(Post.user_id),
+            "follower_count": db.session.query(followers.c.followed_id, db.func.count())
+            .filter(followers.c.followed_id.in_(ids))
+            .group_by(followers.c.followed_id),
+            "followed_count": db.session.query(followers.c.follower_id, db.func.count())
+            .filter(followers.c.follower_id.in_(ids))
+            .group_by(followers.c.follower_id),
+            "unread_message_count": db.session.query(
+                Message.recipient_id, db.func.count(Message.id)
+            )
+            .join(User, User.id == Message.recipient_id)
+            .filter(Message.recipient_id.in_(ids))
+            .filter(
+                Message.timestamp
+                > db.func.coalesce(User.last_message_read_time, datetime(1900, 1, 1))
+            )
+            .group_by(Message.recipient_id),
+        }
+        for name, query in queries.items():
+            for id, count in query:
+                counts[id][name] = count
+
+        return counts
+
+    @staticmethod
+    def repair_counts(batch_size=500):
+        """Recompute the counters of every user in batches; return how many drifted."""
+        repaired = 0
+        last_id = 0
+        while True:
+            users = (
+                User.query.filter(User.id > last_id)
+                .order_by(User.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not users:
+                return repaired
+
+            counts = User.load_counts([user.id for user in users])
+            for user in users:
+                drifted = {
+                    name: count
+                    for name, count in counts[user.id].items()
+                    if getattr(user, name) != count
+                }
+                for name, count in drifted.items():
+                    setattr(user, name, count)
+                repaired += bool(drifted)
+            db.session.commit()
+            last_id = users[-1].id
+
+    # Columns kept out of the session user cache; they load on demand
+    _uncached = {"password_hash", "token", "token_expiration"}
+
+    @staticmethod
+    def from_cache(id):
+        """Rebuild a cached user and attach it to the session without a query."""
+        if not current_app.config["USER_CACHE_TTL"]:
+            return None
+        try:
+            cached = current_app.redis.get(f"user:{id}")
+        except redis.exceptions.RedisError:
+            return None
+        if cached is None:
+            return None
+
+        values = json.loads(cached)
+        # Set the loaded state directly: neither __init__ nor the attribute
+        # validators need to run again for a row that was already valid
+        user = User.__mapper__.class_manager.new_instance()
+        for column in User.__table__.columns:
+            if column.key in values:
+                value = values[column.key]
+                if isinstance(column.type, db.DateTime) and value:
+                    value = datetime.fromisoformat(value)
+                set_committed_value(user, column.key, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def store_in_cache(self):
+        ttl = current_app.config["USER_CACHE_TTL"]
+        if not ttl:
+            return None
+
+        values = {}
+        for column in User.__table__.columns:
+            if column.key not in self._uncached:
+                value = getattr(self, column.key)
+                values[column.key] = (
+                    value.isoformat() if isinstance(value, datetime) else value
+                )
+        try:
+            current_app.redis.set(f"user:{self.id}", json.dumps(values), ex=ttl)
+        except redis.exceptions.RedisError:
+            pass
+
+    def ping(self):
+        """Record activity, writing last_seen at most once per LAST_SEEN_INTERVAL."""
+        now = datetime.utcnow()
+        interval = timedelta(seconds=current_app.config["LAST_SEEN_INTERVAL"])
+        if self.last_seen is None or now - self.last_seen >= interval:
+            self.last_seen = now
+            db.session.commit()
+
+    @property
+    def profile_version(self):
+        """Changes whenever anything shown next to the user's posts changes."""
+        return (self.username, self.avatar_hash)
+
+    @property
+    def version(self):
+        """Changes whenever anything in to_dict() changes."""
+        return (
+            self.id,
+            self.profile_version,
+            self.about_me,
+            self.last_seen,
+            self.post_count,
+            self.follower_count,
+            self.followed_count,
+        )
+
     def to_dict(self, include_email=False):
         data = {
             "id": self.id,
             "username": self.username,
             "last_seen": self.last_seen.isoformat() + "Z",
             "about_me": self.about_me,
-            "post_count": self.posts.count(),
-            "follower_count": self.followers.count(),
-            "followed_count": self.followed.count(),
+            "post_count": self.post_count,
+            "follower_count": self.follower_count,
+            "followed_count": self.followed_count,
             "_links": {
                 "self": url_for("api.get_user", id=self.id),
                 "followers": url_for("api.get_followers", id=self.id),
@@ -182,19 +396,31 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
                 self.set_password(data["password"])
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, user=self, payload_json=json.dumps(data))
-        db.session.add(n)
+        """Set the user's notification called name, replacing any earlier one."""
+        if self.id is None:
+            db.session.flush()
+        n = Notification(
+            name=name, user_id=self.id, payload_json=json.dumps(data), timestamp=time()
+        )
+        _upsert_notification(n)
+        # Rapid updates coalesce: only the latest of each name is published
+        db.session.info.setdefault("notifications", {})[(self.id, name)] = n
         return n
 
     def new_messages(self):
         """Return count of unread messags."""
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return (
-            Message.query.filter_by(recipient=self)
-            .filter(Message.timestamp > last_read_time)
-            .count()
-        )
+        return self.unread_message_count
+
+    def receive_message(self):
+        """Count a newly sent message and notify the user of their unread total."""
+        self.unread_message_count = User.unread_message_count + 1
+        db.session.flush()
+        self.add_notification("unread_message_count", self.unread_message_count)
+
+    def read_messages(self):
+        self.last_message_read_time = datetime.utcnow()
+        self.unread_message_count = 0
+        self.add_notification("unread_message_count", 0)
 
     def launch_task(self, name, description, *args, **kwargs):
         rq_job = current_app.task_queue.enqueue(
@@ -215,10 +441,56 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self.followed_count = User.followed_count + 1
+            user.follower_count = User.follower_count + 1
+            _queue_timeline_follow(self, user, following=True)
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self.followed_count = User.followed_count - 1
+            user.follower_count = User.follower_count - 1
+            _queue_timeline_follow(self, user, following=False)
+
+    @staticmethod
+    def follow_many(pairs):
+        """Create (follower_id, followed_id) edges in bulk and return the new ones.
+
+        Self-follows, unknown users and existing edges are skipped. Counters are
+        updated in SQL and show on loaded users once the session commits.
+        """
+        pairs = {(a, b) for a, b in pairs if a != b}
+        ids = {id for pair in pairs for id in pair}
+        if not ids:
+            return []
+        known = {id for id, in db.session.query(User.id).filter(User.id.in_(ids))}
+        pairs = {(a, b) for a, b in pairs if a in known and b in known}
+
+        edges = sorted(pairs - _existing_edges(pairs))
+        if edges:
+            db.session.execute(
+                followers.insert(),
+                [{"follower_id": a, "followed_id": b} for a, b in edges],
+            )
+            _update_follow_counts(edges, 1)
+        return edges
+
+    @staticmethod
+    def unfollow_many(pairs):
+        """Remove (follower_id, followed_id) edges in bulk and return those removed."""
+        edges = sorted(_existing_edges(set(pairs)))
+        if edges:
+            db.session.execute(
+                followers.delete().where(
+                    db.and_(
+                        followers.c.follower_id == db.bindparam("follower"),
+                        followers.c.followed_id == db.bindparam("followed"),
+                    )
+                ),
+                [{"follower": a, "followed": b} for a, b in edges],
+            )
+            _update_follow_counts(edges, -1)
+        return edges
 
     def is_following(self, user):
         return self.followed.filter(followers.c.followed_id == user.id).count() > 0
@@ -231,6 +503,52 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
 
         return followed.union(own).order_by(Post.timestamp.desc())
 
+    def timeline_page(self, cursor, per_page):
+        """Return a page of the materialized home timeline, or None if it is cold."""
+        keys = [Post.timestamp, Post.id]
+        values, direction = pagination.decode_cursor(cursor, keys)
+        result = timeline.page(
+            self.id,
+            values[-1] if values else None,
+            per_page,
+            backwards=direction == "prev",
+        )
+        if result is None:
+            return None
+
+        ids, start, size, trimmed = result
+        if not ids and trimmed:
+            # Older posts were trimmed from the cache and only live in SQL
+            return None
+
+        query = Post.query.options(db.joinedload(Post.author))
+        posts = {post.id: post for post in query.filter(Post.id.in_(ids))}
+        items = [posts[i] for i in ids if i in posts]
+
+        # Past a trimmed timeline the next page is served by SQL
+        has_next = trimmed or start + len(ids) < size
+        return pagination.KeysetPage(
+            items,
+            next_cursor=pagination.encode_cursor(items[-1], keys, "next")
+            if items and has_next
+            else None,
+            prev_cursor=pagination.encode_cursor(items[0], keys, "prev")
+            if items and start > 0
+            else None,
+        )
+
+    def rebuild_timeline(self):
+        followed = db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id
+        )
+        rows = (
+            db.session.query(Post.id, Post.timestamp)
+            .filter(db.or_(Post.user_id == self.id, Post.user_id.in_(followed)))
+            .order_by(Post.timestamp.desc())
+            .limit(current_app.config["TIMELINE_MAX_LENGTH"])
+        )
+        timeline.fill(self.id, {id: timeline.score(ts) for id, ts in rows})
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
@@ -257,14 +575,26 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             return
         return User.query.get(id)
 
+    @staticmethod
+    def email_digest(email):
+        # Gravatar hashes the trimmed, lowercased address
+        return md5(email.strip().lower().encode("utf-8")).hexdigest()
+
+    @db.validates("email")
+    def validate_email(self, key, email):
+        # Keep the Gravatar digest in step so avatar() never has to hash
+        self.avatar_hash = User.email_digest(email) if email else None
+        return email
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode("utf-8")).hexdigest()
+        digest = self.avatar_hash or User.email_digest(self.email)
         return f"https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}"
 
 
 class Post(SearchableMixin, db.Model):
 
     __searchable__ = ["body"]
+    __table_args__ = (db.Index("ix_post_user_id_timestamp", "user_id", "timestamp"),)
 
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
@@ -275,6 +605,10 @@ class Post(SearchableMixin, db.Model):
 
 class Message(db.Model):
 
+    __table_args__ = (
+        db.Index("ix_message_recipient_id_timestamp", "recipient_id", "timestamp"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey("user.id"))
     recipient_id = db.Column(db.Integer, db.ForeignKey("user.id"))
@@ -287,6 +621,12 @@ class Message(db.Model):
 
 class Notification(db.Model):
 
+    __table_args__ = (
+        db.Index("ix_notification_user_id_timestamp", "user_id", "timestamp"),
+        # A user has at most one notification of each name; see add_notification
+        db.Index("ix_notification_user_id_name", "user_id", "name", unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
@@ -296,6 +636,26 @@ class Notification(db.Model):
     def get_payload(self):
         return json.loads(str(self.payload_json))
 
+    @staticmethod
+    def purge_expired(max_age, batch_size=1000):
+        """Delete notifications older than max_age seconds; return how many."""
+        cutoff = time() - max_age
+        purged = 0
+        while True:
+            ids = [
+                id
+                for id, in db.session.query(Notification.id)
+                .filter(Notification.timestamp < cutoff)
+                .limit(batch_size)
+            ]
+            if not ids:
+                return purged
+            Notification.query.filter(Notification.id.in_(ids)).delete(
+                synchronize_session=False
+            )
+            db.session.commit()
+            purged += len(ids)
+
 
 class Task(db.Model):
 
@@ -306,6 +666,8 @@ class Task(db.Model):
     complete = db.Column(db.Boolean, default=False)
 
     def get_rq_job(self):
+        import rq
+
         try:
             return rq.job.Job.fetch(id=self.id, connection=current_app.redis)
         except (rq.exceptions.NoSuchJobError, redis.exceptions.RedisError):
@@ -315,6 +677,299 @@ class Task(db.Model):
         job = self.get_rq_job()
         return job.meta.get("progress", 0) if job is not None else 100
 
+    def get_export_path(self):
+        return os.path.join(current_app.config["EXPORT_DIR"], f"{self.id}.ndjson.gz")
+
+    def write_export(self, report_progress):
+        """Stream the user's posts into a gzipped NDJSON file at get_export_path().
+
+        Posts are read in EXPORT_BATCH_SIZE batches, each a keyset query on
+        (timestamp, id) that is fully fetched before report_progress() runs, so
+        memory use is bounded whatever the number of posts and no cursor is open
+        while progress is committed. report_progress() is called with a
+        percentage below 100, at most every EXPORT_PROGRESS_STEP percent or
+        EXPORT_PROGRESS_INTERVAL seconds.
+        """
+        config = current_app.config
+        total_posts = max(self.user.post_count, 1)
+        posts = Post.__table__
+        query = (
+            db.select([posts.c.id, posts.c.body, posts.c.timestamp])
+            .where(posts.c.user_id == self.user_id)
+            .order_by(posts.c.timestamp.asc(), posts.c.id.asc())
+            .limit(config["EXPORT_BATCH_SIZE"])
+        )
+
+        path = self.get_export_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        reported, reported_at, written = 0, monotonic(), 0
+        last = None
+        with gzip.open(f"{path}.tmp", "wt") as f:
+            while True:
+                batch = query
+                if last is not None:
+                    batch = query.where(
+                        db.or_(
+                            posts.c.timestamp > last.timestamp,
+                            db.and_(
+                                posts.c.timestamp == last.timestamp,
+                                posts.c.id > last.id,
+                            ),
+                        )
+                    )
+                rows = db.session.execute(batch).fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    post = {
+                        "body": row.body,
+                        "timestamp": row.timestamp.isoformat() + "Z",
+                    }
+                    f.write(json.dumps(post) + "\n")
+                written += len(rows)
+                last = rows[-1]
+
+                # Throttle progress updates, each of which is a commit
+                progress = min(written * 100 // total_posts, 99)
+                now = monotonic()
+                if (
+                    progress - reported >= config["EXPORT_PROGRESS_STEP"]
+                    or now - reported_at >= config["EXPORT_PROGRESS_INTERVAL"]
+                ):
+                    report_progress(progress)
+                    reported, reported_at = progress, now
+        os.replace(f"{path}.tmp", path)
+        return written
+
+    @staticmethod
+    def purge_exports(max_age):
+        """Delete export files, finished or not, older than max_age seconds."""
+        directory = current_app.config["EXPORT_DIR"]
+        if not os.path.isdir(directory):
+            return 0
+
+        purged = 0
+        cutoff = time() - max_age
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        continue
+                    purged += 1
+        return purged
+
+
+def _update_post_count(delta):
+    def listener(mapper, connection, target):
+        users = User.__table__
+        connection.execute(
+            users.update()
+            .where(users.c.id == target.user_id)
+            .values(post_count=users.c.post_count + delta)
+        )
+
+    return listener
+
+
+def _collect_stale_users(session, flush_context):
+    stale = session.info.setdefault("stale_users", set())
+    for obj in session.dirty | session.deleted:
+        if isinstance(obj, User):
+            stale.add(obj.id)
+    for obj in session.new | session.deleted:
+        if isinstance(obj, Post):
+            stale.add(obj.user_id)
+
+
+def _expire_cached_users(session):
+    stale = session.info.pop("stale_users", None)
+    if stale and current_app.config["USER_CACHE_TTL"]:
+        try:
+            current_app.redis.delete(*[f"user:{id}" for id in stale])
+        except redis.exceptions.RedisError:
+            current_app.logger.warning("Could not expire cached users", exc_info=True)
+
+
+def _discard_stale_users(session, previous_transaction):
+    session.info.pop("stale_users", None)
+
+
+def _upsert_notification(n):
+    """Insert or overwrite the notification row with n's (user_id, name)."""
+    table = Notification.__table__
+    values = {
+        "name": n.name,
+        "user_id": n.user_id,
+        "payload_json": n.payload_json,
+        "timestamp": n.timestamp,
+    }
+    changes = {"payload_json": n.payload_json, "timestamp": n.timestamp}
+
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(table).values(**values)
+        db.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=["user_id", "name"], set_=changes
+            )
+        )
+    elif dialect == "mysql":
+        statement = mysql.insert(table).values(**values)
+        db.session.execute(statement.on_duplicate_key_update(**changes))
+    else:
+        # SQLAlchemy 1.3 cannot emit SQLite's ON CONFLICT; the UPDATE takes the
+        # database write lock, so no other writer can insert in between
+        result = db.session.execute(
+            table.update()
+            .where(db.and_(table.c.user_id == n.user_id, table.c.name == n.name))
+            .values(**changes)
+        )
+        if result.rowcount == 0:
+            db.session.execute(table.insert().values(**values))
+
+
+def _publish_notifications(session):
+    notifications = session.info.pop("notifications", None)
+    if notifications:
+        streaming.publish(notifications.values())
+
+
+def _discard_notifications(session, previous_transaction):
+    session.info.pop("notifications", None)
+
+
+def _queue_token_invalidation(token):
+    # Only after the commit: invalidating earlier would let a concurrent request
+    # cache the still valid row again
+    db.session.info.setdefault("stale_tokens", set()).add(token)
+
+
+def _invalidate_tokens(session):
+    for token in session.info.pop("stale_tokens", ()):
+        tokencache.invalidate(token)
+
+
+def _discard_stale_tokens(session, previous_transaction):
+    session.info.pop("stale_tokens", None)
+
+
+def _existing_edges(pairs):
+    """Return which of the (follower_id, followed_id) pairs are already edges."""
+    if not pairs:
+        return set()
+    rows = db.session.query(followers.c.follower_id, followers.c.followed_id).filter(
+        followers.c.follower_id.in_({a for a, _ in pairs}),
+        followers.c.followed_id.in_({b for _, b in pairs}),
+    )
+    return {(a, b) for a, b in rows} & pairs
+
+
+def _update_follow_counts(edges, delta):
+    """Apply the counter changes of added or removed edges in a few UPDATEs.
+
+    Users are grouped by how much their counter changes, so a batch costs one
+    statement per distinct change rather than one per user. The followers'
+    timelines are dropped after commit, to be rebuilt on their next read.
+    """
+    changes = {}
+    for column, ids in (
+        ("followed_count", [a for a, _ in edges]),
+        ("follower_count", [b for _, b in edges]),
+    ):
+        for id, n in Counter(ids).items():
+            changes.setdefault((column, n * delta), []).append(id)
+    for (column, change), ids in changes.items():
+        db.session.query(User).filter(User.id.in_(ids)).update(
+            {column: getattr(User, column) + change}, synchronize_session=False
+        )
+
+    info = db.session.info
+    info.setdefault("stale_users", set()).update(id for edge in edges for id in edge)
+    if timeline.enabled():
+        follower_ids = sorted({a for a, _ in edges})
+        info.setdefault("timeline_updates", []).append(
+            ("invalidate", follower_ids, None)
+        )
+
+
+def _queue_timeline_follow(follower, followed, following):
+    if timeline.enabled():
+        db.session.info.setdefault("timeline_follows", []).append(
+            (follower.id, followed.id, following)
+        )
+
+
+def _collect_timeline_updates(session, flush_context):
+    """Resolve timeline changes while the flush can still run SQL.
+
+    Redis is only written in after_commit, once the rows are durable.
+    """
+    if not timeline.enabled():
+        return None
+
+    updates = session.info.setdefault("timeline_updates", [])
+    max_length = current_app.config["TIMELINE_MAX_LENGTH"]
+
+    def follower_ids(user_id):
+        rows = session.query(followers.c.follower_id).filter(
+            followers.c.followed_id == user_id
+        )
+        return [user_id] + [row[0] for row in rows]
+
+    new_posts = {}
+    for obj in session.new:
+        if isinstance(obj, Post):
+            entries = new_posts.setdefault(obj.user_id, {})
+            entries[obj.id] = timeline.score(obj.timestamp)
+    for user_id, entries in new_posts.items():
+        updates.append(("add", follower_ids(user_id), entries))
+
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            updates.append(("remove", follower_ids(obj.user_id), [obj.id]))
+
+    for follower_id, followed_id, following in session.info.pop("timeline_follows", []):
+        rows = (
+            session.query(Post.id, Post.timestamp)
+            .filter_by(user_id=followed_id)
+            .order_by(Post.timestamp.desc())
+            .limit(max_length)
+        )
+        if following:
+            entries = {id: timeline.score(ts) for id, ts in rows}
+            updates.append(("add", [follower_id], entries))
+        else:
+            updates.append(("remove", [follower_id], [id for id, _ in rows]))
+
+
+def _apply_timeline_updates(session):
+    for action, user_ids, payload in session.info.pop("timeline_updates", []):
+        if action == "add":
+            timeline.add_entries(user_ids, payload)
+        elif action == "remove":
+            timeline.remove_entries(user_ids, payload)
+        else:
+            timeline.invalidate(user_ids)
+
+
+def _discard_timeline_updates(session, previous_transaction):
+    session.info.pop("timeline_follows", None)
+    session.info.pop("timeline_updates", None)
+
 
+db.event.listen(Post, "after_insert", _update_post_count(1))
+db.event.listen(Post, "after_delete", _update_post_count(-1))
 db.event.listen(db.session, "before_commit", SearchableMixin.before_commit)
 db.event.listen(db.session, "after_commit", SearchableMixin.after_commit)
+db.event.listen(db.session, "after_flush", _collect_timeline_updates)
+db.event.listen(db.session, "after_commit", _apply_timeline_updates)
+db.event.listen(db.session, "after_soft_rollback", _discard_timeline_updates)
+db.event.listen(db.session, "after_flush", _collect_stale_users)
+db.event.listen(db.session, "after_commit", _expire_cached_users)
+db.event.listen(db.session, "after_soft_rollback", _discard_stale_users)
+db.event.listen(db.session, "after_commit", _publish_notifications)
+db.event.listen(db.session, "after_soft_rollback", _discard_notifications)
+db.event.listen(db.session, "after_commit", _invalidate_tokens)
+db.event.listen(db.session, "after_soft_rollback", _discard_stale_tokens)
@@ -0,0 +1,115 @@
+import base64
+import binascii
+from datetime import datetime
+import json
+
+from flask import abort
+
+from app import db
+
+
+class KeysetPage:
+    """A page of a keyset-paginated query, with opaque cursors to its neighbours."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def encode_cursor(item, keys, direction):
+    values = [getattr(item, key.key) for key in keys]
+    payload = [direction] + [
+        v.isoformat() if isinstance(v, datetime) else v for v in values
+    ]
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, keys):
+    """Return (values, direction) for cursor, or (None, "next") without one.
+
+    A cursor that was not made by encode_cursor() for these keys aborts the
+    request with a 404, like any other link to a page that does not exist.
+    """
+    if not cursor:
+        return None, "next"
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        direction, *values = json.loads(raw.decode("utf-8"))
+        if direction not in ("next", "prev") or len(values) != len(keys):
+            raise ValueError(cursor)
+        values = [_decode_value(key, v) for key, v in zip(keys, values)]
+    except (binascii.Error, ValueError, TypeError):
+        abort(404)
+
+    return values, direction
+
+
+def _decode_value(key, value):
+    if isinstance(key.type, db.DateTime):
+        return datetime.fromisoformat(value)
+    # bool is an int too, but never a valid key
+    if isinstance(key.type, db.Integer) and (
+        not isinstance(value, int) or isinstance(value, bool)
+    ):
+        raise ValueError(value)
+    return value
+
+
+def _beyond(keys, values, descending):
+    """Filter for rows strictly past values in (keys) order."""
+    clauses = []
+    for i, key in enumerate(keys):
+        step = key < values[i] if descending else key > values[i]
+        ties = [k == v for k, v in zip(keys[:i], values[:i])]
+        clauses.append(db.and_(*ties, step))
+    return db.or_(*clauses)
+
+
+def paginate(query, keys, cursor=None, per_page=10, descending=True, count=False):
+    """Return a KeysetPage of query ordered by keys, starting after cursor.
+
+    The last key must be unique (usually the primary key) so that the ordering
+    is total. Unlike offset pagination, every page costs the same index seek
+    and the total is only counted when asked for.
+    """
+    values, direction = decode_cursor(cursor, keys)
+    backwards = direction == "prev"
+
+    # Walking backwards flips the sort order; the page is reversed afterwards
+    desc = descending != backwards
+    page_query = query.order_by(None)
+    if values is not None:
+        page_query = page_query.filter(_beyond(keys, values, desc))
+    order = [key.desc() if desc else key.asc() for key in keys]
+    items = page_query.order_by(*order).limit(per_page + 1).all()
+
+    more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+
+    has_next = values is not None if backwards else more
+    has_prev = more if backwards else values is not None
+
+    return KeysetPage(
+        items,
+        next_cursor=encode_cursor(items[-1], keys, "next")
+        if items and has_next
+        else None,
+        prev_cursor=encode_cursor(items[0], keys, "prev")
+        if items and has_prev
+        else None,
+        total=query.order_by(None).count() if count else None,
+    )
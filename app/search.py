@@ -1,35 +1,153 @@
+import json
+import time
+
 from flask import current_app
+import redis
 
+from app.localsearch import LocalSearchBackend
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return None
+DEAD_LETTER_KEY = "search:dead-letter"
 
+
+def index_action(index, model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
 
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    return {"op": "index", "index": index, "id": model.id, "doc": payload}
+
+
+def delete_action(index, model):
+    return {"op": "delete", "index": index, "id": model.id}
+
+
+class ElasticsearchBackend:
+    """Search backend that talks to an Elasticsearch cluster."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def apply(self, actions):
+        """Send one _bulk request; return the actions that should be retried."""
+        from elasticsearch.exceptions import TransportError
+
+        body = []
+        for action in actions:
+            meta = {"_index": action["index"], "_id": action["id"]}
+            body.append({action["op"]: meta})
+            if action["op"] == "index":
+                body.append(action["doc"])
+
+        try:
+            response = self.client.bulk(body=body)
+        except TransportError:
+            current_app.logger.warning("Bulk index request failed", exc_info=True)
+            return actions
+
+        if not response.get("errors"):
+            return []
+
+        failed = []
+        for action, item in zip(actions, response["items"]):
+            status = item[action["op"]]["status"]
+            # Deleting a document that was never indexed is not a failure
+            if status >= 300 and not (action["op"] == "delete" and status == 404):
+                failed.append(action)
+        return failed
+
+    def query(self, index, query, page, per_page):
+        body = {
+            "query": {"multi_match": {"query": query, "fields": ["*"]}},
+            "from": (page - 1) * per_page,
+            "size": per_page,
+        }
+
+        search = self.client.search(index=index, body=body)
+        ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
+
+        return ids, search["hits"]["total"]["value"]
+
+
+def create_backend(app):
+    """Return the search backend configured for app, or None to disable search."""
+    if app.elasticsearch:
+        return ElasticsearchBackend(app.elasticsearch)
+    if app.config["SEARCH_INDEX_DIR"]:
+        return LocalSearchBackend(app.config["SEARCH_INDEX_DIR"])
+    return None
+
+
+def add_to_index(index, model):
+    if not current_app.search_backend:
+        return None
+
+    bulk([index_action(index, model)])
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return None
 
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    bulk([delete_action(index, model)])
 
 
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
-        return [], None
+def enqueue(actions):
+    """Hand index changes to the task queue, or flush them inline if so configured."""
+    if not current_app.search_backend or not actions:
+        return None
+
+    if current_app.config["SEARCH_INDEX_ASYNC"]:
+        current_app.task_queue.enqueue("app.tasks.index_documents", actions)
+    else:
+        bulk(actions)
+
+
+def _dead_letter(actions):
+    current_app.logger.error(f"Giving up on {len(actions)} search index actions")
+    try:
+        current_app.redis.rpush(DEAD_LETTER_KEY, *[json.dumps(a) for a in actions])
+    except redis.exceptions.RedisError:
+        current_app.logger.error("Could not dead-letter search actions", exc_info=True)
 
-    body = {
-        "query": {"multi_match": {"query": query, "fields": ["*"]}},
-        "from": (page - 1) * per_page,
-        "size": per_page,
-    }
 
-    search = current_app.elasticsearch.search(index=index, body=body)
-    ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
+def bulk(actions):
+    """Apply index actions to the search backend, in chunks and with retries.
+
+    Actions that still fail after SEARCH_BULK_RETRIES attempts are pushed onto
+    a Redis dead-letter list; see requeue_dead_letters().
+    """
+    backend = current_app.search_backend
+    if not backend:
+        return None
+
+    chunk_size = current_app.config["SEARCH_BULK_CHUNK_SIZE"]
+    retries = current_app.config["SEARCH_BULK_RETRIES"]
+    backoff = current_app.config["SEARCH_BULK_BACKOFF"]
+
+    for start in range(0, len(actions), chunk_size):
+        pending = actions[start : start + chunk_size]
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            pending = backend.apply(pending)
+            if not pending:
+                break
+        else:
+            _dead_letter(pending)
+
+
+def requeue_dead_letters():
+    """Move dead-lettered actions back onto the task queue; return how many."""
+    pipe = current_app.redis.pipeline()
+    pipe.lrange(DEAD_LETTER_KEY, 0, -1)
+    pipe.delete(DEAD_LETTER_KEY)
+    actions = [json.loads(a) for a in pipe.execute()[0]]
+    enqueue(actions)
+    return len(actions)
+
+
+def query_index(index, query, page, per_page):
+    if not current_app.search_backend:
+        return [], 0
 
-    return ids, search["hits"]["total"]["value"]
+    return current_app.search_backend.query(index, query, page, per_page)
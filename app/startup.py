@@ -0,0 +1,49 @@
+"""Startup profiling.
+
+create_app() is run in a fresh interpreter with -X importtime, and the self
+time of every imported module is summed per top-level package. A dependency
+is thereby charged for all of its own modules, but not for other packages it
+pulls in, which are reported on their own.
+"""
+from collections import Counter
+import os
+import re
+import subprocess
+import sys
+
+_IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)")
+
+_SCRIPT = """\
+import time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app(profile={profile!r})
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def profile(app, profile="web"):
+    """Time a cold start of the given app profile.
+
+    Returns the seconds spent importing the app package, the seconds spent in
+    create_app(), and a Counter of import microseconds per top-level package.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _SCRIPT.format(profile=profile)],
+        cwd=os.path.dirname(app.root_path),
+        capture_output=True,
+        text=True,
+    )
+    lines = result.stderr.splitlines()
+    if result.returncode:
+        errors = [line for line in lines if not line.startswith("import time:")]
+        raise RuntimeError("create_app() failed:\n" + "\n".join(errors))
+
+    packages = Counter()
+    for line in lines:
+        match = _IMPORT_TIME.match(line)
+        if match:
+            packages[match.group(3).split(".")[0]] += int(match.group(1))
+    imports, setup = map(float, result.stdout.splitlines()[-1].split())
+    return imports, setup, packages
@@ -0,0 +1,61 @@
+"""Server-Sent Events delivery of user notifications over Redis pub/sub."""
+import json
+import time
+
+from flask import current_app
+import redis
+
+
+def _channel(user_id):
+    return f"notifications:{user_id}"
+
+
+def format_event(name, data, timestamp):
+    return f"id: {timestamp}\nevent: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+def publish(notifications):
+    """Publish committed Notification rows to their users' channels."""
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for n in notifications:
+            message = {
+                "name": n.name,
+                "data": n.get_payload(),
+                "timestamp": n.timestamp,
+            }
+            pipe.publish(_channel(n.user_id), json.dumps(message))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning("Could not publish notifications", exc_info=True)
+
+
+def subscribe(user_id):
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(_channel(user_id))
+    return pubsub
+
+
+def stream(pubsub, backlog, timeout, heartbeat):
+    """Yield SSE events: the backlog, then live messages until timeout.
+
+    Needs no application or request context, so the response does not hold a
+    database connection while it waits. Clients reconnect automatically once
+    the stream ends, resuming from the Last-Event-ID they last saw.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        yield f"retry: {heartbeat * 1000}\n\n"
+        for event in backlog:
+            yield event
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=heartbeat)
+            if message is None:
+                yield ": keep-alive\n\n"
+                continue
+            n = json.loads(message["data"])
+            yield format_event(n["name"], n["data"], n["timestamp"])
+    except redis.exceptions.RedisError:
+        return
+    finally:
+        pubsub.close()
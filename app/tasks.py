@@ -1,16 +1,15 @@
-import json
 import sys
 import time
 
 from rq import get_current_job
-from flask import render_template
+from flask import render_template, url_for
 
-from app import create_app, db
-from app.auth.email import send_email
-from app.models import Post, Task, User
+from app import create_app, db, search
+from app.auth.email import deliver, requeue_emails, send_email, take_queued_emails
+from app.models import Notification, Task, User
 
 
-app = create_app()
+app = create_app(profile="worker")
 app.app_context().push()
 
 
@@ -32,40 +31,75 @@ def _set_task_progress(progress):
 
 
 def export_posts(user_id):
+    """Write a user's posts to an export file and email a download link."""
     try:
         user = User.query.get(user_id)
+        task = Task.query.get(get_current_job().get_id())
         _set_task_progress(0)
-        data = []
-        total_posts = user.posts.count()
-        for i, post in enumerate(user.posts.order_by(Post.timestamp.asc())):
-            data.append(
-                {"body": post.body, "timestamp": post.timestamp.isoformat() + "Z"}
-            )
-            time.sleep(5)  # Only needed to test out progress reporting
-            _set_task_progress(i / total_posts * 100)
+
+        task.write_export(_set_task_progress)
 
         # Send email to user
-        send_email(
-            subject="Your blog post export",
-            sender=app.config["ADMINS"][0],
-            recipients=[user.email],
-            text_body=render_template("email/export_posts.txt", user=user),
-            html_body=render_template("email/export_posts.html", user=user),
-            attachments=[
-                (
-                    "posts.json",
-                    "application/json",
-                    json.dumps({"posts": data}, indent=4),
-                )
-            ],
-            sync=True,
-        )
+        with app.test_request_context(base_url=app.config["EXTERNAL_URL"]):
+            download_url = url_for(
+                "main.download_export", task_id=task.id, _external=True
+            )
+            send_email(
+                subject="Your blog post export",
+                sender=app.config["ADMINS"][0],
+                recipients=[user.email],
+                text_body=render_template(
+                    "email/export_posts.txt", user=user, download_url=download_url
+                ),
+                html_body=render_template(
+                    "email/export_posts.html", user=user, download_url=download_url
+                ),
+                sync=True,
+            )
     except:
+        db.session.rollback()
         app.logger.error("Unhandled exception", exc_info=sys.exc_info())
     finally:
         _set_task_progress(100)
 
 
+def index_documents(actions):
+    search.bulk(actions)
+
+
+def repair_counters(batch_size=500):
+    try:
+        repaired = User.repair_counts(batch_size=batch_size)
+        app.logger.info(f"Repaired counters of {repaired} users")
+    except:  # noqa: E722
+        app.logger.error("Unhandled exception", exc_info=sys.exc_info())
+
+
+def purge_notifications(batch_size=1000):
+    try:
+        purged = Notification.purge_expired(
+            app.config["NOTIFICATION_TTL"], batch_size=batch_size
+        )
+        app.logger.info(f"Purged {purged} expired notifications")
+    except:  # noqa: E722
+        app.logger.error("Unhandled exception", exc_info=sys.exc_info())
+
+
+def purge_exports():
+    try:
+        purged = Task.purge_exports(app.config["EXPORT_TTL"])
+        app.logger.info(f"Purged {purged} expired exports")
+    except:  # noqa: E722
+        app.logger.error("Unhandled exception", exc_info=sys.exc_info())
+
+
+def send_emails():
+    try:
+        requeue_emails(deliver(take_queued_emails()))
+    except:  # noqa: E722
+        app.logger.error("Unhandled exception", exc_info=sys.exc_info())
+
+
 def example(seconds):
     job = get_current_job()
     for i in range(seconds):
@@ -0,0 +1,58 @@
+"""Template bytecode cache and warm-up.
+
+Compiled templates are kept in TEMPLATE_CACHE_DIR, which every worker (and the
+image build, through `flask templates compile`) shares, so a new worker only
+unmarshals bytecode instead of parsing and compiling each template. With
+TEMPLATE_WARMUP set, create_app() also loads every template up front so the
+first request does not pay for it.
+"""
+import os
+import tempfile
+
+from jinja2 import FileSystemBytecodeCache, TemplateError
+
+TEMPLATE_EXTENSIONS = (".html", ".txt")
+
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+    """FileSystemBytecodeCache that several processes can write at once.
+
+    Bytecode is written to a temporary file and renamed into place, so that no
+    worker ever reads a file another one is still writing.
+    """
+
+    def dump_bytecode(self, bucket):
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                bucket.write_bytecode(f)
+            os.replace(path, self._get_cache_filename(bucket))
+        except OSError:
+            # The cache is only an optimisation; the template is compiled anyway
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def warm_up(app):
+    """Load, and so compile or read from the bytecode cache, every template.
+
+    Returns the number of templates loaded.
+    """
+    env = app.jinja_env
+    names = env.list_templates(filter_func=lambda n: n.endswith(TEMPLATE_EXTENSIONS))
+    loaded = 0
+    for name in names:
+        try:
+            env.get_template(name)
+        except TemplateError:
+            app.logger.exception(f"Could not load template {name}")
+        else:
+            loaded += 1
+    return loaded
+
+
+def init_app(app):
+    directory = app.config["TEMPLATE_CACHE_DIR"]
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = SharedBytecodeCache(directory)
@@ -0,0 +1,143 @@
+from datetime import timezone
+
+from flask import current_app
+import redis
+
+# Every filled timeline holds this member, scored below any post, so that a
+# timeline with no posts still exists and counts as warm. Its score records
+# whether older posts were trimmed and so are only found in SQL.
+SENTINEL = b"sentinel"
+COMPLETE = float("-inf")
+TRIMMED = -1.0
+
+
+def _key(user_id):
+    return f"timeline:{user_id}"
+
+
+def score(timestamp):
+    """Convert a naive UTC post timestamp into a sorted set score."""
+    return timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+
+def enabled():
+    return current_app.config["TIMELINE_ENABLED"]
+
+
+def add_entries(user_ids, entries):
+    """Push {post_id: score} entries onto the warm timelines of user_ids.
+
+    Cold timelines are left alone so that they get rebuilt in full on the next
+    read, rather than being mistaken for a complete timeline. Timelines that
+    grow past TIMELINE_MAX_LENGTH lose their oldest posts and are marked as
+    trimmed.
+    """
+    if not enabled() or not user_ids or not entries:
+        return None
+
+    max_length = current_app.config["TIMELINE_MAX_LENGTH"]
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.exists(_key(user_id))
+        warm = [u for u, exists in zip(user_ids, pipe.execute()) if exists]
+
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id in warm:
+            pipe.zadd(_key(user_id), entries)
+            # Rank 0 is the sentinel
+            pipe.zremrangebyrank(_key(user_id), 1, -max_length - 1)
+        trimmed = [u for u, n in zip(warm, pipe.execute()[1::2]) if n]
+
+        if trimmed:
+            pipe = current_app.redis.pipeline(transaction=False)
+            for user_id in trimmed:
+                pipe.zadd(_key(user_id), {SENTINEL: TRIMMED}, xx=True)
+            pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning("Could not update timelines", exc_info=True)
+
+
+def remove_entries(user_ids, post_ids):
+    if not enabled() or not user_ids or not post_ids:
+        return None
+
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zrem(_key(user_id), *post_ids)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning("Could not update timelines", exc_info=True)
+
+
+def invalidate(user_ids):
+    """Drop the timelines of user_ids, to be rebuilt in full on their next read."""
+    if not enabled() or not user_ids:
+        return None
+
+    try:
+        current_app.redis.delete(*[_key(user_id) for user_id in user_ids])
+    except redis.exceptions.RedisError:
+        current_app.logger.warning("Could not invalidate timelines", exc_info=True)
+
+
+def fill(user_id, entries):
+    """Replace the timeline of user_id with the given {post_id: score} entries.
+
+    A full timeline (TIMELINE_MAX_LENGTH entries) is marked as trimmed, since
+    older posts may exist.
+    """
+    if not enabled():
+        return None
+
+    key = _key(user_id)
+    trimmed = len(entries) >= current_app.config["TIMELINE_MAX_LENGTH"]
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.delete(key)
+        pipe.zadd(key, {**entries, SENTINEL: TRIMMED if trimmed else COMPLETE})
+        pipe.expire(key, current_app.config["TIMELINE_TTL"])
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.warning("Could not rebuild timeline", exc_info=True)
+
+
+def page(user_id, anchor_id, count, backwards=False):
+    """Return (post_ids, start, size, trimmed) for count posts next to anchor_id.
+
+    Posts come newest first. Without an anchor the page starts at the newest
+    post; with one, it holds the posts after it (or before it, walking
+    backwards). trimmed tells whether older posts than the cached ones exist.
+    Returns None if the timeline or the anchor is not cached.
+    """
+    if not enabled():
+        return None
+
+    key = _key(user_id)
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.zscore(key, SENTINEL)
+        pipe.zcount(key, 0, "+inf")  # all but the sentinel
+        pipe.zrevrank(key, anchor_id or 0)
+        pipe.expire(key, current_app.config["TIMELINE_TTL"])
+        marker, size, rank, _ = pipe.execute()
+        if marker is None or (anchor_id and rank is None):
+            return None
+        trimmed = marker == TRIMMED
+
+        if anchor_id is None:
+            start = 0
+        elif backwards:
+            start = max(rank - count, 0)
+            count = rank - start
+            if not count:
+                return [], start, size, trimmed
+        else:
+            start = rank + 1
+        ids = current_app.redis.zrevrange(key, start, start + count - 1)
+    except redis.exceptions.RedisError:
+        current_app.logger.warning("Could not read timeline", exc_info=True)
+        return None
+
+    return [int(i) for i in ids if i != SENTINEL], start, size, trimmed
@@ -0,0 +1,96 @@
+"""Cache of API token -> (user id, expiry), so token auth can skip the database.
+
+Entries live in a small per-process LRU in front of Redis and are keyed by a
+SHA-256 of the token, so raw tokens are never stored. Local entries are only
+trusted for TOKEN_CACHE_LOCAL_TTL seconds, which bounds how long a token
+revoked through another worker can keep working in this one.
+"""
+from collections import OrderedDict
+from datetime import timezone
+from hashlib import sha256
+import json
+import threading
+import time
+
+from flask import current_app
+import redis
+
+_local = OrderedDict()
+_lock = threading.Lock()
+_stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+
+def _key(token):
+    return sha256(token.encode("utf-8")).hexdigest()
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def _remember(key, user_id, expires):
+    local_ttl = current_app.config["TOKEN_CACHE_LOCAL_TTL"]
+    local_expires = min(expires, time.time() + local_ttl)
+    with _lock:
+        _local[key] = (user_id, local_expires)
+        _local.move_to_end(key)
+        while len(_local) > current_app.config["TOKEN_CACHE_SIZE"]:
+            _local.popitem(last=False)
+
+
+def lookup(token):
+    """Return the user id of a valid cached token, or None on a miss."""
+    key = _key(token)
+    now = time.time()
+
+    with _lock:
+        entry = _local.get(key)
+        if entry is not None and entry[1] > now:
+            _local.move_to_end(key)
+            _stats["local_hits"] += 1
+            return entry[0]
+
+    try:
+        cached = current_app.redis.get(f"token:{key}")
+    except redis.exceptions.RedisError:
+        cached = None
+    if cached is not None:
+        user_id, expires = json.loads(cached)
+        if expires > now:
+            _remember(key, user_id, expires)
+            _count("redis_hits")
+            return user_id
+
+    _count("misses")
+    return None
+
+
+def store(token, user_id, expiration):
+    """Cache a verified token until its (naive UTC) expiration datetime."""
+    key = _key(token)
+    expires = expiration.replace(tzinfo=timezone.utc).timestamp()
+    ttl = int(expires - time.time())
+    if ttl <= 0:
+        return None
+
+    _remember(key, user_id, expires)
+    try:
+        current_app.redis.set(f"token:{key}", json.dumps([user_id, expires]), ex=ttl)
+    except redis.exceptions.RedisError:
+        pass
+
+
+def invalidate(token):
+    key = _key(token)
+    with _lock:
+        _local.pop(key, None)
+    try:
+        current_app.redis.delete(f"token:{key}")
+    except redis.exceptions.RedisError:
+        current_app.logger.warning("Could not invalidate cached token", exc_info=True)
+
+
+def stats():
+    with _lock:
+        return dict(_stats, size=len(_local))
@@ -1,23 +1,113 @@
+from collections import OrderedDict
+from hashlib import sha256
 import json
+import threading
 
 from flask import current_app
-import requests
 from flask_babel import _
+import redis
+import requests
+from requests.adapters import HTTPAdapter
 
+_local = OrderedDict()
+_lock = threading.Lock()
 
-def translate(text, target_language):
-    if not current_app.config.get("LANGUAGE_API_KEY"):
-        return "Configuration error"
+
+class TranslationError(Exception):
+    pass
+
+
+class YandexProvider:
+    """Translation provider backed by the Yandex API, over a pooled session."""
 
     url = "https://translate.yandex.net/api/v1.5/tr.json/translate"
 
-    body = {
-        "key": current_app.config["LANGUAGE_API_KEY"],
-        "text": text,
-        "lang": target_language,
-    }
-    r = requests.post(url, data=body)
+    def __init__(self, api_key, timeout):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=10, max_retries=1))
+
+    def translate(self, texts, target_language):
+        """Translate all texts in a single upstream request."""
+        body = [("key", self.api_key), ("lang", target_language)]
+        body.extend(("text", text) for text in texts)
+        try:
+            r = self.session.post(self.url, data=body, timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            raise TranslationError(_("Connection error."))
+
+        if r.status_code != 200:
+            raise TranslationError(_("Connection error."))
+        return json.loads(r.content.decode("utf-8-sig"))["text"]
+
+
+def create_provider(app):
+    if not app.config["LANGUAGE_API_KEY"]:
+        return None
+    return YandexProvider(
+        app.config["LANGUAGE_API_KEY"], app.config["TRANSLATION_TIMEOUT"]
+    )
+
 
-    if r.status_code != 200:
-        return "Connection error."
-    return json.loads(r.content.decode("utf-8-sig"))
+def _key(text, target_language):
+    digest = sha256(text.encode("utf-8")).hexdigest()
+    return f"translation:{target_language}:{digest}"
+
+
+def _remember(key, translation):
+    with _lock:
+        _local[key] = translation
+        _local.move_to_end(key)
+        while len(_local) > current_app.config["TRANSLATION_CACHE_SIZE"]:
+            _local.popitem(last=False)
+
+
+def translate_many(texts, target_language):
+    """Translate texts, going upstream once for whatever is not cached yet."""
+    if not current_app.translator:
+        raise TranslationError(_("Configuration error"))
+
+    keys = [_key(text, target_language) for text in texts]
+    translations = {}
+    with _lock:
+        for key in keys:
+            if key in _local:
+                translations[key] = _local[key]
+                _local.move_to_end(key)
+
+    missing = [key for key in dict.fromkeys(keys) if key not in translations]
+    if missing:
+        try:
+            cached = current_app.redis.mget(missing)
+        except redis.exceptions.RedisError:
+            cached = [None] * len(missing)
+        for key, translation in zip(missing, cached):
+            if translation is not None:
+                translations[key] = translation.decode("utf-8")
+                _remember(key, translations[key])
+
+    upstream = {}
+    for key, text in zip(keys, texts):
+        if key not in translations:
+            upstream[key] = text
+    if upstream:
+        results = current_app.translator.translate(
+            list(upstream.values()), target_language
+        )
+        ttl = current_app.config["TRANSLATION_CACHE_TTL"]
+        pipe = current_app.redis.pipeline(transaction=False)
+        for key, translation in zip(upstream, results):
+            translations[key] = translation
+            _remember(key, translation)
+            pipe.set(key, translation, ex=ttl)
+        try:
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            pass
+
+    return [translations[key] for key in keys]
+
+
+def translate(text, target_language):
+    return translate_many([text], target_language)[0]
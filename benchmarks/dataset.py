@@ -0,0 +1,121 @@
+"""Deterministic synthetic dataset shared by the benchmark scripts.
+
+Rows are inserted through lightweight table constructs naming only the columns
+they fill, so the same seed works against older migration revisions as well as
+head. Denormalized counters are left for User.repair_counts() to fill in.
+"""
+from datetime import datetime, timedelta
+from hashlib import md5
+import random
+
+from sqlalchemy import column, table
+
+PASSWORD = "benchmark"
+
+users_table = table(
+    "user",
+    column("id"),
+    column("username"),
+    column("email"),
+    column("avatar_hash"),
+    column("password_hash"),
+    column("last_seen"),
+)
+followers_table = table("followers", column("follower_id"), column("followed_id"))
+post_table = table("post", column("body"), column("user_id"), column("timestamp"))
+message_table = table(
+    "message",
+    column("body"),
+    column("sender_id"),
+    column("recipient_id"),
+    column("timestamp"),
+)
+notification_table = table(
+    "notification",
+    column("name"),
+    column("user_id"),
+    column("payload_json"),
+    column("timestamp"),
+)
+
+
+def seed(
+    db,
+    users=200,
+    follows=30,
+    posts=20,
+    messages=20,
+    notifications=20,
+    random_seed=42,
+    password_hash=None,
+):
+    """Insert the dataset and return the new user ids, in username order.
+
+    Every user gets ``follows`` follow edges and ``posts``, ``messages`` and
+    ``notifications`` rows of each kind, spread over the last ~70 days. All
+    users share ``password_hash`` so that logging in needs no extra hashing.
+    """
+    rng = random.Random(random_seed)
+    now = datetime.utcnow()
+
+    def recently():
+        return now - timedelta(minutes=rng.randrange(100000))
+
+    rows = []
+    for i in range(users):
+        email = f"user{i}@example.com"
+        rows.append(
+            {
+                "username": f"user{i}",
+                "email": email,
+                "avatar_hash": md5(email.encode("utf-8")).hexdigest(),
+                "password_hash": password_hash,
+                "last_seen": now,
+            }
+        )
+    db.session.execute(users_table.insert(), rows)
+    ids = [id for id, in db.session.query(users_table.c.id).order_by(users_table.c.id)]
+
+    follows = min(follows, len(ids) - 1)
+    edges = [
+        (a, b)
+        for a in ids
+        for b in [b for b in rng.sample(ids, follows + 1) if b != a][:follows]
+    ]
+    inserts = [
+        (followers_table, [{"follower_id": a, "followed_id": b} for a, b in edges],),
+        (
+            post_table,
+            [
+                {"body": f"post {n}", "user_id": id, "timestamp": recently()}
+                for id in ids
+                for n in range(posts)
+            ],
+        ),
+        (
+            message_table,
+            [
+                {
+                    "body": f"message {n}",
+                    "sender_id": rng.choice(ids),
+                    "recipient_id": id,
+                    "timestamp": recently(),
+                }
+                for id in ids
+                for n in range(messages)
+            ],
+        ),
+        (
+            notification_table,
+            [
+                {"name": f"n{n}", "user_id": id, "payload_json": "0", "timestamp": n}
+                for id in ids
+                for n in range(notifications)
+            ],
+        ),
+    ]
+    for target, rows in inserts:
+        if rows:
+            db.session.execute(target.insert(), rows)
+    db.session.commit()
+    return ids
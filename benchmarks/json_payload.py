@@ -0,0 +1,82 @@
+"""Compare JSON backends and response compression on the /api/users payload.
+
+For each JSON backend the page of users is encoded in-process, to isolate the
+serializer, and then fetched through the test client with every content
+coding, to measure the whole response path and the bytes sent.
+
+    python benchmarks/json_payload.py [--per-page 100] [--requests 200]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from load_test import create_benchmark_app, prepare
+
+ENCODINGS = ["identity", "gzip", "br"]
+
+
+def mean_ms(f, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        f()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def measure(app, id, token, args):
+    from app.models import User
+
+    path = f"/api/users?per_page={args.per_page}"
+    results = {}
+    with app.test_request_context(path):
+        resources = User.collection_page(User.query, None, args.per_page)
+        data = User.page_to_collection_dict(
+            resources, None, args.per_page, "api.get_users"
+        )
+        encoder = app.json_encoder(
+            separators=(",", ":"),
+            sort_keys=app.config["JSON_SORT_KEYS"],
+            ensure_ascii=app.config["JSON_AS_ASCII"],
+        )
+        results["encode_ms"] = mean_ms(lambda: encoder.encode(data), args.requests)
+
+    client = app.test_client()
+    for encoding in ENCODINGS:
+        headers = {"Authorization": f"Bearer {token}", "Accept-Encoding": encoding}
+        response = client.get(path, headers=headers)
+        results[encoding] = {
+            "content_encoding": response.headers.get("Content-Encoding", "identity"),
+            "bytes": len(response.get_data()),
+            "request_ms": mean_ms(
+                lambda: client.get(path, headers=headers), args.requests
+            ),
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--per-page", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=200, help="per measurement")
+    args = parser.parse_args(argv)
+
+    database_url = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "json.db")
+    dataset = argparse.Namespace(
+        users=args.users, follows=10, posts=1, messages=0, notifications=0
+    )
+    _, id, token = prepare(create_benchmark_app(database_url), dataset)
+
+    results = {}
+    for backend in ("stdlib", "orjson"):
+        app = create_benchmark_app(database_url, JSON_BACKEND=backend)
+        with app.app_context():
+            results[backend] = measure(app, id, token, args)
+            results[backend]["encoder"] = app.json_encoder.__name__
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
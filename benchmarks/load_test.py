@@ -0,0 +1,348 @@
+"""Load test the web and API endpoints against a seeded synthetic dataset.
+
+A scratch database is migrated to head and seeded (see dataset.py), then every
+scenario is driven either through the Flask test client, which also counts the
+SQL queries of each request, or through gunicorn serving the app from a child
+process, hit by concurrent HTTP clients. Latency percentiles, queries per
+request and throughput are printed and written as JSON, and a previous results
+file can be passed to --compare to see what changed between commits.
+
+    python benchmarks/load_test.py                             # test client
+    python benchmarks/load_test.py --server --concurrency 8    # gunicorn
+    python benchmarks/load_test.py --database postgresql:///bench \\
+        --users 2000 --compare benchmarks/results/abc1234-client.json
+"""
+import argparse
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from dataset import PASSWORD, seed
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+sys.path.insert(0, BASEDIR)
+
+# name: (method, path, authentication)
+SCENARIOS = {
+    "index": ("GET", "/", "session"),
+    "explore": ("GET", "/explore", "session"),
+    "user": ("GET", "/users/{username}", "session"),
+    "notifications": ("GET", "/notifications", "session"),
+    "api_users": ("GET", "/api/users", "token"),
+    "api_followers": ("GET", "/api/users/{id}/followers", "token"),
+    "api_tokens": ("POST", "/api/tokens", "basic"),
+}
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    rank = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies, errors, elapsed, queries=None):
+    ordered = sorted(latencies)
+    ms = 1000
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "mean_ms": sum(ordered) / len(ordered) * ms if ordered else None,
+        "p50_ms": percentile(ordered, 50) * ms if ordered else None,
+        "p90_ms": percentile(ordered, 90) * ms if ordered else None,
+        "p99_ms": percentile(ordered, 99) * ms if ordered else None,
+        "max_ms": ordered[-1] * ms if ordered else None,
+        "throughput_rps": len(ordered) / elapsed if elapsed else None,
+        "queries_per_request": sum(queries) / len(queries) if queries else None,
+    }
+
+
+def create_benchmark_app(database_url, **settings):
+    """Create the app on database_url, with any extra config settings."""
+    from app import create_app
+    from config import Config
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        ELASTICSEARCH_URL = None
+        SEARCH_INDEX_DIR = None
+        WTF_CSRF_ENABLED = False
+        LOG_TO_STDOUT = True
+
+    app = create_app(type("BenchConfig", (BenchConfig,), settings))
+    app.logger.setLevel(logging.ERROR)
+    return app
+
+
+def prepare(app, args):
+    """Migrate and seed the database; return (username, user id, API token)."""
+    from flask_migrate import upgrade
+    from werkzeug.security import generate_password_hash
+
+    from app import db
+    from app.models import User
+
+    with app.app_context():
+        upgrade(directory=os.path.join(BASEDIR, "migrations"))
+        ids = seed(
+            db,
+            users=args.users,
+            follows=args.follows,
+            posts=args.posts,
+            messages=args.messages,
+            notifications=args.notifications,
+            password_hash=generate_password_hash(PASSWORD),
+        )
+        User.repair_counts()
+
+        user = User.query.get(ids[0])
+        token = user.get_token(expires_in=24 * 3600)
+        username = user.username
+        db.session.commit()
+        db.engine.dispose()
+        return username, ids[0], token
+
+
+def count_queries(app):
+    """Return a list that gets one entry per SQL statement the app executes."""
+    from sqlalchemy import event
+
+    from app import db
+
+    statements = []
+    with app.app_context():
+        event.listen(
+            db.engine, "before_cursor_execute", lambda *args: statements.append(None),
+        )
+    return statements
+
+
+def request_args(scenario, username, id, token):
+    method, path, auth = SCENARIOS[scenario]
+    headers = {}
+    if auth == "token":
+        headers["Authorization"] = f"Bearer {token}"
+    elif auth == "basic":
+        credentials = f"{username}:{PASSWORD}".encode("utf-8")
+        headers["Authorization"] = "Basic " + base64.b64encode(credentials).decode()
+    return method, path.format(username=username, id=id), headers
+
+
+def run_client(app, scenarios, username, id, token, args):
+    """Drive every scenario sequentially through the Flask test client."""
+    statements = count_queries(app)
+    client = app.test_client()
+    client.post("/auth/login", data={"username": username, "password": PASSWORD})
+
+    results = {}
+    for scenario in scenarios:
+        method, path, headers = request_args(scenario, username, id, token)
+        for _ in range(args.warmup):
+            client.open(path, method=method, headers=headers)
+
+        latencies, queries, errors = [], [], 0
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            before = len(statements)
+            t = time.perf_counter()
+            response = client.open(path, method=method, headers=headers)
+            latencies.append(time.perf_counter() - t)
+            queries.append(len(statements) - before)
+            errors += response.status_code >= 400
+        elapsed = time.perf_counter() - started
+        results[scenario] = summarize(latencies, errors, elapsed, queries)
+    return results
+
+
+def serve(database_url, port, workers):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"127.0.0.1:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("loglevel", "warning")
+
+        def load(self):
+            return create_benchmark_app(database_url)
+
+    Server().run()
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"gunicorn did not start listening on port {port}")
+
+
+def run_server(database_url, scenarios, username, id, token, args):
+    """Serve the app with gunicorn and drive it with concurrent HTTP clients."""
+    import requests
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = multiprocessing.Process(
+        target=serve, args=(database_url, port, args.workers)
+    )
+    server.start()
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+            local.session.post(
+                f"http://127.0.0.1:{port}/auth/login",
+                data={"username": username, "password": PASSWORD},
+            )
+        return local.session
+
+    def timed(method, url, headers):
+        t = time.perf_counter()
+        response = session().request(method, url, headers=headers)
+        return time.perf_counter() - t, response.status_code >= 400
+
+    results = {}
+    try:
+        wait_for(port)
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for scenario in scenarios:
+                method, path, headers = request_args(scenario, username, id, token)
+                url = f"http://127.0.0.1:{port}{path}"
+
+                def call(_):
+                    return timed(method, url, headers)
+
+                list(pool.map(call, range(args.warmup)))
+                started = time.perf_counter()
+                timings = list(pool.map(call, range(args.requests)))
+                elapsed = time.perf_counter() - started
+                results[scenario] = summarize(
+                    [latency for latency, _ in timings],
+                    sum(error for _, error in timings),
+                    elapsed,
+                )
+    finally:
+        server.terminate()
+        server.join()
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BASEDIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    columns = ["p50_ms", "p90_ms", "p99_ms", "throughput_rps", "queries_per_request"]
+    print(f"{'scenario':<16}" + "".join(f"{c:>22}" for c in columns))
+    for scenario, result in results.items():
+        old = (baseline or {}).get(scenario, {})
+        cells = []
+        for c in columns:
+            value = result[c]
+            cell = "-" if value is None else f"{value:.2f}"
+            if value is not None and old.get(c):
+                cell += f" ({(value - old[c]) / old[c] * 100:+.0f}%)"
+            cells.append(f"{cell:>22}")
+        print(f"{scenario:<16}" + "".join(cells))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", help="empty database URL (default: SQLite)")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--follows", type=int, default=30, help="edges per user")
+    parser.add_argument("--posts", type=int, default=20, help="posts per user")
+    parser.add_argument("--messages", type=int, default=20, help="per user")
+    parser.add_argument("--notifications", type=int, default=20, help="per user")
+    parser.add_argument("--requests", type=int, default=200, help="per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="per scenario")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="run only this scenario (repeatable)",
+    )
+    parser.add_argument("--server", action="store_true", help="serve with gunicorn")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads")
+    parser.add_argument("--output", help="results file (default: benchmarks/results)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    database_url = args.database or "sqlite:///" + os.path.join(
+        tempfile.mkdtemp(), "load_test.db"
+    )
+    scenarios = args.scenario or list(SCENARIOS)
+    mode = "server" if args.server else "client"
+
+    app = create_benchmark_app(database_url)
+    username, id, token = prepare(app, args)
+    if args.server:
+        results = run_server(database_url, scenarios, username, id, token, args)
+    else:
+        results = run_client(app, scenarios, username, id, token, args)
+
+    commit = current_commit()
+    output = {
+        "commit": commit,
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "mode": mode,
+        "database": database_url.split(":", 1)[0],
+        "dataset": {
+            "users": args.users,
+            "follows": args.follows,
+            "posts": args.posts,
+            "messages": args.messages,
+            "notifications": args.notifications,
+        },
+        "requests": args.requests,
+        "warmup": args.warmup,
+        "concurrency": args.concurrency if args.server else 1,
+        "workers": args.workers if args.server else None,
+        "results": results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    report(results, baseline)
+
+    path = args.output or os.path.join(
+        BASEDIR, "benchmarks", "results", f"{commit or 'unknown'}-{mode}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"\nResults written to {path}")
+
+
+if __name__ == "__main__":
+    main()
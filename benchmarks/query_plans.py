@@ -0,0 +1,145 @@
+"""Print the query plans of the hot queries before and after the index migration.
+
+The database is migrated to the revision just before the schema tuning
+migration, seeded, and every hot query is explained; it is then upgraded to
+head and explained again.
+
+    python benchmarks/query_plans.py                      # temporary SQLite file
+    python benchmarks/query_plans.py postgresql:///bench  # an empty Postgres db
+"""
+from datetime import datetime
+import os
+import sys
+import tempfile
+
+from sqlalchemy import and_, column, select, table, union
+
+from dataset import seed
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+BEFORE = "a3d9e0c4b7f2"
+
+sys.path.insert(0, BASEDIR)
+
+# The hot queries are built from lightweight tables naming only the columns
+# they use, so that they run unchanged against BEFORE and head however the
+# models change later. They mirror the SQL the ORM emits for the same calls.
+user_table = table("user", column("id"), column("username"))
+followers_table = table("followers", column("follower_id"), column("followed_id"))
+post_table = table(
+    "post", column("id"), column("body"), column("timestamp"), column("user_id")
+)
+message_table = table(
+    "message", column("id"), column("recipient_id"), column("timestamp")
+)
+notification_table = table(
+    "notification",
+    column("id"),
+    column("name"),
+    column("user_id"),
+    column("timestamp"),
+    column("payload_json"),
+)
+
+
+def hot_queries(user_id):
+    u, f, p = user_table, followers_table, post_table
+    m, n = message_table, notification_table
+
+    timeline = union(
+        select([p])
+        .select_from(p.join(f, f.c.followed_id == p.c.user_id))
+        .where(f.c.follower_id == user_id),
+        select([p]).where(p.c.user_id == user_id),
+    ).alias()
+    return {
+        # User.followed_posts()
+        "followed_posts": select([timeline])
+        .order_by(timeline.c.timestamp.desc())
+        .limit(10),
+        # User.posts
+        "user posts": select([p])
+        .where(p.c.user_id == user_id)
+        .order_by(p.c.timestamp.desc())
+        .limit(10),
+        # User.is_following()
+        "is_following": select([u])
+        .select_from(u.join(f, f.c.followed_id == u.c.id))
+        .where(and_(f.c.follower_id == user_id, f.c.followed_id == user_id)),
+        # User.followers
+        "followers": select([u])
+        .select_from(u.join(f, f.c.follower_id == u.c.id))
+        .where(f.c.followed_id == user_id)
+        .order_by(u.c.id)
+        .limit(10),
+        # Messages received since a user last read them
+        "new_messages": select([m]).where(
+            and_(m.c.recipient_id == user_id, m.c.timestamp > datetime(1900, 1, 1))
+        ),
+        # main.notifications
+        "notifications": select([n])
+        .where(and_(n.c.user_id == user_id, n.c.timestamp > 0.0))
+        .order_by(n.c.timestamp.asc()),
+    }
+
+
+def explain(db, statement):
+    compiled = statement.compile(dialect=db.engine.dialect)
+    if compiled.positional:
+        params = [compiled.params[name] for name in compiled.positiontup]
+    else:
+        params = compiled.params
+
+    prefix = "EXPLAIN QUERY PLAN " if db.engine.name == "sqlite" else "EXPLAIN "
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(prefix + str(compiled), params)
+        return [" ".join(str(col) for col in row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def main(url=None):
+    if url is None:
+        url = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "plans.db")
+
+    from flask_migrate import upgrade
+
+    from app import create_app, db
+    from config import Config
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = url
+        SEARCH_INDEX_DIR = None
+        ELASTICSEARCH_URL = None
+        USER_CACHE_TTL = 0
+
+    app = create_app(BenchConfig)
+    directory = os.path.join(BASEDIR, "migrations")
+    with app.app_context():
+        upgrade(directory=directory, revision=BEFORE)
+        user_id = seed(db)[0]
+
+        plans = {}
+        for label in ("before", "after"):
+            if label == "after":
+                db.session.commit()
+                upgrade(directory=directory)
+            if db.engine.name == "postgresql":
+                db.session.execute("ANALYZE")
+                db.session.commit()
+            for name, query in hot_queries(user_id).items():
+                plans.setdefault(name, {})[label] = explain(db, query)
+
+    for name, plan in plans.items():
+        print(f"== {name}")
+        for label in ("before", "after"):
+            print(f"-- {label}")
+            for line in plan[label]:
+                print(f"   {line}")
+        print()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
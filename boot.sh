@@ -8,5 +8,9 @@ while true; do
     echo Upgrade command failed, retrying in 5 secs...
     sleep 5
 done
-flask translate compile
-exec gunicorn -b :5000 --access-logfile - --error-logfile - microblog:app
+# Message catalogs and template bytecode are compiled when the image is built
+# Notification streams (NOTIFICATION_STREAMING) need an async worker class,
+# e.g. GUNICORN_WORKER_CLASS=gevent with gevent installed; with the default sync
+# workers each open stream occupies a whole worker.
+exec gunicorn -b :5000 ${GUNICORN_WORKER_CLASS:+-k $GUNICORN_WORKER_CLASS} \
+    --access-logfile - --error-logfile - microblog:app
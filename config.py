@@ -11,16 +11,118 @@ class Config:
     LOG_TO_STDOUT = os.getenv("LOG_TO_STDOUT")
     SECRET_KEY = os.getenv("SECRET_KEY", "test dev key")
     LANGUAGE_API_KEY = os.getenv("LANGUAGE_API_KEY")
+    TRANSLATION_TIMEOUT = float(os.getenv("TRANSLATION_TIMEOUT", 5))
+    TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", 1024))
+    TRANSLATION_CACHE_TTL = int(os.getenv("TRANSLATION_CACHE_TTL", 7 * 24 * 3600))
+    # Limits of a /translate/batch request: texts, and characters per text
+    TRANSLATION_BATCH_SIZE = int(os.getenv("TRANSLATION_BATCH_SIZE", 50))
+    TRANSLATION_MAX_LENGTH = int(os.getenv("TRANSLATION_MAX_LENGTH", 1000))
     POSTS_PER_PAGE = 10
+    # JSON encoding ("orjson" when installed, or "stdlib") and compression of
+    # responses of at least COMPRESS_MIN_SIZE bytes. Only the API writes
+    # non-ASCII characters unescaped; see app/fastjson.py.
+    JSON_BACKEND = os.getenv("JSON_BACKEND", "orjson")
+    COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 500))
+    COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", 6))
+    COMPRESS_BR_QUALITY = int(os.getenv("COMPRESS_BR_QUALITY", 4))
+    COMPRESS_MIMETYPES = [
+        "application/json",
+        "application/javascript",
+        "text/css",
+        "text/html",
+        "text/plain",
+    ]
+    # Cache-Control per blueprint, for responses whose view sets none. Clients
+    # may keep pages and API resources but must revalidate them (cheap 304s).
+    CACHE_CONTROL = {
+        "api": "private, no-cache",
+        "main": "private, no-cache",
+        "auth": "no-store",
+    }
+    # Compiled template bytecode shared by all workers, and whether create_app()
+    # loads every template up front
+    TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR") or os.path.join(
+        basedir, "template-cache"
+    )
+    TEMPLATE_WARMUP = os.getenv("TEMPLATE_NO_WARMUP") is None
+    FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", 4096))
     LANGUAGES = ["en", "it"]
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
 
+    # Session user cache and last_seen write coalescing, in seconds
+    USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 60))
+    LAST_SEEN_INTERVAL = int(os.getenv("LAST_SEEN_INTERVAL", 60))
+
+    # API token verification cache
+    TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 1024))
+    TOKEN_CACHE_LOCAL_TTL = int(os.getenv("TOKEN_CACHE_LOCAL_TTL", 30))
+
+    # Server-Sent Events notification stream, in seconds. Each open stream holds
+    # a worker, so only enable it with an async worker class (see boot.sh);
+    # otherwise pages poll for notifications.
+    NOTIFICATION_STREAMING = os.getenv("NOTIFICATION_STREAMING") is not None
+    NOTIFICATION_STREAM_TIMEOUT = int(os.getenv("NOTIFICATION_STREAM_TIMEOUT", 300))
+    NOTIFICATION_HEARTBEAT = int(os.getenv("NOTIFICATION_HEARTBEAT", 15))
+    # Notifications untouched for this long are purged, in seconds
+    NOTIFICATION_TTL = int(os.getenv("NOTIFICATION_TTL", 7 * 24 * 3600))
+
+    # Materialized home timelines (Redis sorted sets)
+    TIMELINE_ENABLED = os.getenv("TIMELINE_ENABLED") is not None
+    TIMELINE_MAX_LENGTH = int(os.getenv("TIMELINE_MAX_LENGTH", 800))
+    TIMELINE_TTL = int(os.getenv("TIMELINE_TTL", 7 * 24 * 3600))
+
+    # Most follow edges changed per bulk API request or import transaction
+    FOLLOW_BATCH_SIZE = int(os.getenv("FOLLOW_BATCH_SIZE", 400))
+
     # Database
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL") or "sqlite:///" + os.path.join(
         basedir, "app.db"
     )
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Connection pool, for databases other than SQLite; recycle is in seconds
+    DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 5))
+    DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", 10))
+    DATABASE_POOL_RECYCLE = int(os.getenv("DATABASE_POOL_RECYCLE", 1800))
+    DATABASE_POOL_PRE_PING = os.getenv("DATABASE_POOL_NO_PRE_PING") is None
+    # Optional read replica for read-only views, and how long a browser session
+    # keeps reading from the primary after it commits
+    DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+    SQLALCHEMY_BINDS = {"replica": DATABASE_REPLICA_URL} if DATABASE_REPLICA_URL else {}
+    REPLICA_STICKY_SECONDS = int(os.getenv("REPLICA_STICKY_SECONDS", 5))
+
+    # Request and SQL instrumentation; durations in seconds
+    SLOW_REQUEST_THRESHOLD = float(os.getenv("SLOW_REQUEST_THRESHOLD", 1))
+    SLOW_REQUEST_QUERIES = int(os.getenv("SLOW_REQUEST_QUERIES", 50))
+    SLOW_QUERY_THRESHOLD = float(os.getenv("SLOW_QUERY_THRESHOLD", 0.25))
+    METRICS_SLOWEST_STATEMENTS = int(os.getenv("METRICS_SLOWEST_STATEMENTS", 5))
+    SERVER_TIMING = os.getenv("SERVER_TIMING") is not None
+    # /metrics is served to these addresses, or to requests with the header
+    # "Authorization: Bearer $METRICS_TOKEN". Behind a proxy every request comes
+    # from the proxy's address, so use the token there.
+    METRICS_ALLOWED_IPS = os.getenv("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
     ELASTICSEARCH_URL = os.getenv("ELASTICSEARCH_URL")
+    # Local full-text index used when ELASTICSEARCH_URL is unset. Posts are
+    # indexed by the RQ worker, so web and worker processes must share this
+    # directory: when they run in separate containers, mount the same volume
+    # and point SEARCH_INDEX_DIR at it.
+    SEARCH_INDEX_DIR = os.getenv("SEARCH_INDEX_DIR") or os.path.join(
+        basedir, "search-index"
+    )
+    SEARCH_INDEX_ASYNC = os.getenv("SEARCH_INDEX_SYNC") is None
+    SEARCH_BULK_CHUNK_SIZE = int(os.getenv("SEARCH_BULK_CHUNK_SIZE", 500))
+    SEARCH_BULK_RETRIES = int(os.getenv("SEARCH_BULK_RETRIES", 3))
+    SEARCH_BULK_BACKOFF = float(os.getenv("SEARCH_BULK_BACKOFF", 0.5))
+
+    # Post exports, written where both web and worker processes can read them
+    EXPORT_DIR = os.getenv("EXPORT_DIR") or os.path.join(basedir, "exports")
+    EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+    EXPORT_PROGRESS_STEP = int(os.getenv("EXPORT_PROGRESS_STEP", 5))  # percent
+    EXPORT_PROGRESS_INTERVAL = float(os.getenv("EXPORT_PROGRESS_INTERVAL", 2))
+    # Export files are deleted by `flask exports purge` after this long, in seconds
+    EXPORT_TTL = int(os.getenv("EXPORT_TTL", 7 * 24 * 3600))
+    EXTERNAL_URL = os.getenv("EXTERNAL_URL", "http://localhost:5000")
 
     # Email Notifications
     MAIL_SERVER = os.getenv("MAIL_SERVER")
@@ -28,4 +130,13 @@ class Config:
     MAIL_USE_TLS = os.getenv("MAIL_USE_TLS") is not None
     MAIL_USERNAME = os.getenv("MAIL_USERNAME")
     MAIL_PASSWORD = os.getenv("MAIL_PASSWORD")
+    # Outgoing email goes through the task queue unless MAIL_SYNC is set. For a
+    # local SMTP sink use e.g. `python -m aiosmtpd -n -l localhost:8025` with
+    # MAIL_SERVER=localhost and MAIL_PORT=8025.
+    MAIL_ASYNC = os.getenv("MAIL_SYNC") is None
+    MAIL_MAX_EMAILS = int(os.getenv("MAIL_MAX_EMAILS", 100))  # per connection
+    MAIL_RETRIES = int(os.getenv("MAIL_RETRIES", 3))
+    MAIL_BACKOFF = float(os.getenv("MAIL_BACKOFF", 1))
+    # Seconds before a lost send job stops holding back new ones
+    MAIL_FLUSH_TIMEOUT = int(os.getenv("MAIL_FLUSH_TIMEOUT", 300))
     ADMINS = ["somebody@example.com"]
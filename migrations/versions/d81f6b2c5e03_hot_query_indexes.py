@@ -0,0 +1,55 @@
+"""hot query indexes
+
+Revision ID: d81f6b2c5e03
+Revises: a3d9e0c4b7f2
+Create Date: 2026-10-18 13:45:52.684410
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81f6b2c5e03'
+down_revision = 'a3d9e0c4b7f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A primary key needs complete, unique edges: drop broken rows and collapse
+    # any duplicated follow into a single row first
+    followers = sa.table('followers', sa.column('follower_id'), sa.column('followed_id'))
+    conn = op.get_bind()
+    conn.execute(followers.delete().where(sa.or_(
+        followers.c.follower_id.is_(None), followers.c.followed_id.is_(None))))
+    duplicates = conn.execute(
+        sa.select([followers.c.follower_id, followers.c.followed_id])
+        .group_by(followers.c.follower_id, followers.c.followed_id)
+        .having(sa.func.count() > 1)).fetchall()
+    for follower_id, followed_id in duplicates:
+        conn.execute(followers.delete().where(sa.and_(
+            followers.c.follower_id == follower_id,
+            followers.c.followed_id == followed_id)))
+        conn.execute(followers.insert().values(
+            follower_id=follower_id, followed_id=followed_id))
+
+    with op.batch_alter_table('followers') as batch_op:
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('pk_followers', ['follower_id', 'followed_id'])
+    op.create_index('ix_followers_followed_id_follower_id', 'followers', ['followed_id', 'follower_id'], unique=False)
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+    op.create_index('ix_message_recipient_id_timestamp', 'message', ['recipient_id', 'timestamp'], unique=False)
+    op.create_index('ix_notification_user_id_timestamp', 'notification', ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_notification_user_id_timestamp', table_name='notification')
+    op.drop_index('ix_message_recipient_id_timestamp', table_name='message')
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    with op.batch_alter_table('followers') as batch_op:
+        batch_op.drop_constraint('pk_followers', type_='primary')
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=True)
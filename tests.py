@@ -1,14 +1,253 @@
+import base64
 from datetime import datetime, timedelta
+import gzip
+from html import unescape
+import json
+import os
+import pickle
+import re
+import smtplib
+import tempfile
 import unittest
+from unittest import mock
 
-from app import create_app, db
+from elasticsearch.exceptions import ConnectionError as ESConnectionError
+from flask import g, render_template, render_template_string, url_for
+from flask_mail import Message as MailMessage
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from app import (
+    create_app,
+    db,
+    fragments,
+    mail,
+    metrics,
+    streaming,
+    templating,
+    timeline,
+    tokencache,
+)
+from app.auth.email import (
+    OUTBOX_KEY,
+    deliver,
+    requeue_emails,
+    send_email,
+    send_password_reset_email,
+    take_queued_emails,
+)
+from app.database import prefer_replica
 from config import Config
-from app.models import Post, User
+from app.localsearch import LocalSearchBackend
+from app.models import Message, Notification, Post, Task, User, user_loader
+from app.search import ElasticsearchBackend
+from app.translate import translate, translate_many
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = "sqlite://"
+    ELASTICSEARCH_URL = None
+    SEARCH_INDEX_DIR = None
+    USER_CACHE_TTL = 0
+    SEARCH_INDEX_ASYNC = False
+    SEARCH_BULK_BACKOFF = 0
+    MAIL_ASYNC = False
+    MAIL_BACKOFF = 0
+    TEMPLATE_CACHE_DIR = None
+    TEMPLATE_WARMUP = False
+    # The row cache is per process; it would outlive each test's database
+    FRAGMENT_CACHE_SIZE = 0
+
+
+class FakeElasticsearch:
+    """In-memory stand-in for the Elasticsearch client's _bulk API."""
+
+    def __init__(self, failures=0):
+        self.indices = {}
+        self.failures = failures
+        self.requests = 0
+
+    def bulk(self, body):
+        self.requests += 1
+        if self.failures:
+            self.failures -= 1
+            raise ESConnectionError("N/A", "fake outage")
+
+        items = []
+        lines = iter(body)
+        for header in lines:
+            ((op, meta),) = header.items()
+            docs = self.indices.setdefault(meta["_index"], {})
+            if op == "index":
+                docs[str(meta["_id"])] = next(lines)
+                status = 201
+            else:
+                status = 200 if docs.pop(str(meta["_id"]), None) else 404
+            items.append({op: {"status": status}})
+        return {"errors": False, "items": items}
+
+
+class FakeRedis:
+    """In-memory stand-in for the few Redis commands the app uses."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def set(self, name, value, ex=None, nx=False):
+        if nx and name in self.data:
+            return None
+        self.data[name] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    def delete(self, *names):
+        return sum(self.data.pop(name, None) is not None for name in names)
+
+    def lpush(self, name, *values):
+        self.data[name] = list(reversed(values)) + self.data.get(name, [])
+        return len(self.data[name])
+
+    def rpush(self, name, *values):
+        self.data.setdefault(name, []).extend(values)
+        return len(self.data[name])
+
+    def lrange(self, name, start, end):
+        values = self.data.get(name, [])
+        return values[start:] if end == -1 else values[start : end + 1]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def publish(self, channel, message):
+        self.data.setdefault(channel, []).append(message)
+        return 0
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+    def exists(self, *names):
+        return sum(name in self.data for name in names)
+
+    def expire(self, name, time):
+        return name in self.data
+
+    # Sorted sets are {member: score} dicts
+
+    def _ranked(self, name):
+        zset = self.data.get(name, {})
+        return sorted(zset, key=lambda member: (zset[member], member))
+
+    @staticmethod
+    def _member(member):
+        return member if isinstance(member, bytes) else str(member).encode()
+
+    @staticmethod
+    def _range(members, start, end):
+        start = max(start + len(members) if start < 0 else start, 0)
+        end = end + len(members) if end < 0 else end
+        return members[start : end + 1] if end >= 0 else []
+
+    def zadd(self, name, mapping, xx=False):
+        if xx and name not in self.data:
+            return 0
+        zset = self.data.setdefault(name, {})
+        added = 0
+        for member, score in mapping.items():
+            member = self._member(member)
+            if xx and member not in zset:
+                continue
+            added += member not in zset
+            zset[member] = float(score)
+        return added
+
+    def zrem(self, name, *members):
+        zset = self.data.get(name, {})
+        removed = sum(zset.pop(self._member(m), None) is not None for m in members)
+        if name in self.data and not zset:
+            del self.data[name]
+        return removed
+
+    def zscore(self, name, member):
+        return self.data.get(name, {}).get(self._member(member))
+
+    def zcount(self, name, min, max):
+        return sum(
+            float(min) <= score <= float(max)
+            for score in self.data.get(name, {}).values()
+        )
+
+    def zrevrank(self, name, member):
+        members = self._ranked(name)[::-1]
+        member = self._member(member)
+        return members.index(member) if member in members else None
+
+    def zrevrange(self, name, start, end):
+        return self._range(self._ranked(name)[::-1], start, end)
+
+    def zremrangebyrank(self, name, start, end):
+        members = self._range(self._ranked(name), start, end)
+        return self.zrem(name, *members)
+
+
+class FakePubSub:
+    """Hands out the messages published to its channels before it was read."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.channels = []
+        self.closed = False
+
+    def subscribe(self, *channels):
+        self.channels.extend(channels)
+
+    def get_message(self, timeout=0):
+        for channel in self.channels:
+            messages = self.redis.data.get(channel)
+            if messages:
+                return {"type": "message", "data": messages.pop(0)}
+        return None
+
+    def close(self):
+        self.closed = True
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [getattr(self.redis, n)(*a, **kw) for n, a, kw in commands]
+
+
+def page_links(html):
+    """Return the (newer, older) pager URLs of a rendered page."""
+    links = []
+    for direction in ("previous", "next"):
+        match = re.search(rf'<li class="{direction}">\s*<a href="([^"]+)"', html)
+        links.append(unescape(match.group(1)) if match else None)
+    return links
+
+
+class StubTranslator:
+    """Translation provider that records upstream calls instead of using the network."""
+
+    def __init__(self):
+        self.calls = []
+
+    def translate(self, texts, target_language):
+        self.calls.append(list(texts))
+        return [f"{target_language}:{text}" for text in texts]
 
 
 class UserModelCase(unittest.TestCase):
@@ -41,6 +280,25 @@ class UserModelCase(unittest.TestCase):
             ),
         )
 
+    def test_avatar_hash(self):
+        digest = "d4c74594d841139328695756648b6bd6"
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(u.avatar_hash, digest)
+
+        u.email = "susan@example.com"
+        db.session.commit()
+        self.assertNotEqual(u.avatar_hash, digest)
+
+        # Gravatar ignores case and surrounding whitespace
+        u.email = " John@Example.COM\n"
+        self.assertEqual(u.avatar_hash, digest)
+
+        with mock.patch.object(User, "email_digest") as email_digest:
+            self.assertIn(f"/avatar/{digest}?", u.avatar(36))
+        email_digest.assert_not_called()
+
     def test_follow(self):
         u1 = User(username="john")
         u2 = User(username="susan")
@@ -64,6 +322,141 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_counters(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        u1.follow(u2)
+        db.session.add(Post(body="post from susan", author=u2))
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.follower_count), (1, 0))
+        self.assertEqual((u2.followed_count, u2.follower_count), (0, 1))
+        self.assertEqual(u2.post_count, 1)
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_count, 0)
+        self.assertEqual(u2.follower_count, 0)
+
+        u2.post_count = 7
+        db.session.commit()
+        self.assertEqual(User.repair_counts(batch_size=1), 1)
+        self.assertEqual(u2.post_count, 1)
+
+    def test_bulk_follow(self):
+        users = [
+            User(username=f"user{i}", email=f"user{i}@example.com") for i in range(4)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+        u1, u2, u3, u4 = users
+        u1.follow(u2)
+        db.session.commit()
+
+        pairs = [(u1.id, u2.id), (u1.id, u3.id), (u1.id, u3.id), (u4.id, u4.id)]
+        pairs += [(u2.id, u3.id), (u4.id, u3.id), (u4.id, 999)]
+        added = User.follow_many(pairs)
+        db.session.commit()
+        self.assertEqual(added, [(u1.id, u3.id), (u2.id, u3.id), (u4.id, u3.id)])
+        self.assertEqual(u1.followed_count, 2)
+        self.assertEqual(u3.follower_count, 3)
+        self.assertTrue(u4.is_following(u3))
+
+        removed = User.unfollow_many([(u1.id, u3.id), (u1.id, u4.id), (u4.id, u3.id)])
+        db.session.commit()
+        self.assertEqual(removed, [(u1.id, u3.id), (u4.id, u3.id)])
+        self.assertEqual(u1.followed_count, 1)
+        self.assertEqual(u3.follower_count, 1)
+        self.assertEqual(User.repair_counts(), 0)
+
+    def test_bulk_follow_api(self):
+        u1, u2 = [
+            User(username=f"user{i}", email=f"user{i}@example.com") for i in range(2)
+        ]
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {u1.get_token()}"}
+        db.session.commit()
+        client = self.app.test_client()
+        url = f"/api/users/{u1.id}/followed"
+
+        for body in [
+            [u2.id],
+            "follow",
+            {"follow": u2.id},
+            {"follow": [True]},
+            {"unfollow": [str(u2.id)]},
+        ]:
+            response = client.post(url, json=body, headers=headers)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertEqual(response.get_json()["error"], "Bad Request")
+        response = client.post(url, data="{", headers=headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(u1.is_following(u2))
+
+        response = client.post(url, json={"follow": [u2.id]}, headers=headers)
+        self.assertEqual(response.get_json(), {"followed": [u2.id], "unfollowed": []})
+
+    def test_unread_message_count(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        for body in ("hi", "there"):
+            db.session.add(Message(author=u1, recipient=u2, body=body))
+            u2.receive_message()
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 2)
+        self.assertEqual(u2.notifications.one().get_payload(), 2)
+
+        u2.read_messages()
+        db.session.commit()
+        self.assertEqual(u2.new_messages(), 0)
+
+        u2.unread_message_count = 5
+        db.session.commit()
+        self.assertEqual(User.repair_counts(), 1)
+        self.assertEqual(u2.new_messages(), 0)
+
+    def test_notifications_are_upserted(self):
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        db.session.commit()
+
+        for progress in (10, 50, 90):
+            u.add_notification("task_progress", {"progress": progress})
+        db.session.commit()
+        u.add_notification("task_progress", {"progress": 100})
+        db.session.commit()
+        self.assertEqual(u.notifications.one().get_payload(), {"progress": 100})
+
+        self.assertEqual(Notification.purge_expired(3600), 0)
+        self.assertEqual(Notification.purge_expired(-1, batch_size=1), 1)
+        self.assertEqual(u.notifications.count(), 0)
+
+    def test_token_cache(self):
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+
+        before = tokencache.stats()
+        self.assertEqual(User.check_token(token), u)
+        self.assertEqual(User.check_token(token), u)
+        after = tokencache.stats()
+        self.assertEqual(after["misses"] - before["misses"], 1)
+        self.assertEqual(after["local_hits"] - before["local_hits"], 1)
+
+        # The cached token stays valid until the revocation is committed
+        u.revoke_token()
+        self.assertEqual(tokencache.lookup(token), u.id)
+        db.session.commit()
+        self.assertIsNone(tokencache.lookup(token))
+        self.assertIsNone(User.check_token(token))
+
     def test_followed_posts(self):
         # Create four users..
         u1 = User(username="john", email="john@example.com")
@@ -106,6 +499,924 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_user_cache(self):
+        self.app.config["USER_CACHE_TTL"] = 60
+        self.app.redis = FakeRedis()
+        u = User(username="john", email="john@example.com", about_me="hi")
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(user_loader(str(u.id)), u)
+        self.assertIn(f"user:{u.id}", self.app.redis.data)
+        db.session.remove()
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            with mock.patch.object(User, "email_digest") as email_digest:
+                cached = user_loader(str(u.id))
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(statements, [])
+        email_digest.assert_not_called()
+        self.assertEqual((cached.username, cached.about_me), ("john", "hi"))
+        self.assertIsInstance(cached.last_seen, datetime)
+
+        # A committed change to the user drops the cached copy
+        cached.about_me = "bye"
+        db.session.commit()
+        self.assertNotIn(f"user:{u.id}", self.app.redis.data)
+        db.session.remove()
+        self.assertEqual(user_loader(str(u.id)).about_me, "bye")
+
+    def test_collection_query_count_is_constant(self):
+        users = [
+            User(username=f"user{i}", email=f"user{i}@example.com") for i in range(20)
+        ]
+        db.session.add_all(users)
+        db.session.add_all(Post(body="post", author=u) for u in users)
+        db.session.commit()
+        for u in users[1:]:
+            users[0].follow(u)
+            u.follow(users[0])
+        db.session.commit()
+
+        def count_queries(per_page):
+            statements = []
+
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            db.event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                with self.app.test_request_context():
+                    data = User.to_collection_dict(
+                        User.query, None, per_page, "api.get_users"
+                    )
+            finally:
+                db.event.remove(db.engine, "before_cursor_execute", record)
+            self.assertEqual(len(data["items"]), per_page)
+            return len(statements)
+
+        self.assertEqual(count_queries(5), count_queries(20))
+
+        with self.app.test_request_context():
+            data = users[0].to_dict()
+        self.assertEqual(data["post_count"], 1)
+        self.assertEqual(data["follower_count"], 19)
+        self.assertEqual(data["followed_count"], 19)
+
+
+class SearchIndexCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.es = FakeElasticsearch()
+        self.app.search_backend = ElasticsearchBackend(self.es)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_commit_indexes_in_bulk(self):
+        u = User(username="john", email="john@example.com")
+        posts = [Post(body=f"post {i}", author=u) for i in range(3)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        self.assertEqual(self.es.requests, 1)
+        self.assertEqual(len(self.es.indices["post"]), 3)
+
+        db.session.delete(posts[0])
+        db.session.commit()
+        docs = self.es.indices["post"].values()
+        self.assertEqual(sorted(d["body"] for d in docs), ["post 1", "post 2"])
+
+    def test_reindex_retries_in_chunks(self):
+        u = User(username="john", email="john@example.com")
+        db.session.add_all([u] + [Post(body=f"post {i}", author=u) for i in range(3)])
+        db.session.commit()
+
+        self.es = FakeElasticsearch(failures=1)
+        self.app.search_backend = ElasticsearchBackend(self.es)
+        Post.reindex(batch_size=2)
+        self.assertEqual(len(self.es.indices["post"]), 3)
+        self.assertEqual(self.es.requests, 3)
+
+    def test_local_backend(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.search_backend = LocalSearchBackend(directory)
+            u = User(username="john", email="john@example.com")
+            p1 = Post(body="the cat sat on the mat", author=u)
+            p2 = Post(body="a cat and another cat", author=u)
+            p3 = Post(body="dogs only", author=u)
+            db.session.add_all([u, p1, p2, p3])
+            db.session.commit()
+
+            posts, total = Post.search("Cat", 1, 10)
+            self.assertEqual(total, 2)
+            self.assertEqual(posts.all(), [p2, p1])
+
+            db.session.delete(p2)
+            db.session.commit()
+
+            # A fresh backend maps the segment persisted on disk
+            self.app.search_backend = LocalSearchBackend(directory)
+            posts, total = Post.search("cat dogs", 1, 1)
+            self.assertEqual(total, 2)
+            self.assertEqual(len(posts.all()), 1)
+
+    def test_local_backend_log(self):
+        with tempfile.TemporaryDirectory() as directory:
+            writer = LocalSearchBackend(directory)
+            reader = LocalSearchBackend(directory)
+
+            def index(doc_id, body):
+                return {
+                    "op": "index",
+                    "index": "post",
+                    "id": doc_id,
+                    "doc": {"body": body},
+                }
+
+            writer.apply([index(1, "red fish"), index(2, "blue fish")])
+            # Writes only append to the log, which other processes read too
+            self.assertFalse(os.path.exists(os.path.join(directory, "post.seg")))
+            self.assertEqual(reader.query("post", "fish", 1, 10), ([2, 1], 2))
+
+            writer.merge("post")
+            self.assertFalse(os.path.exists(os.path.join(directory, "post.log")))
+            writer.apply(
+                [index(1, "green"), {"op": "delete", "index": "post", "id": 2}]
+            )
+            self.assertEqual(reader.query("post", "fish", 1, 10), ([], 0))
+            self.assertEqual(reader.query("post", "green", 1, 10), ([1], 1))
+
+            with mock.patch("app.localsearch.MERGE_MIN_CHANGES", 3):
+                writer.apply([index(3, "green fish")])
+            self.assertFalse(os.path.exists(os.path.join(directory, "post.log")))
+            self.assertEqual(reader.query("post", "green", 1, 10), ([1, 3], 2))
+            self.assertEqual(reader.query("post", "fish", 1, 10), ([3], 1))
+
+
+class TranslationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.translator = StubTranslator()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_batch_translation_is_cached(self):
+        texts = ["buongiorno", "buonanotte", "buongiorno"]
+        self.assertEqual(
+            translate_many(texts, "en"),
+            ["en:buongiorno", "en:buonanotte", "en:buongiorno"],
+        )
+        self.assertEqual(translate("buonanotte", "en"), "en:buonanotte")
+        self.assertEqual(self.app.translator.calls, [["buongiorno", "buonanotte"]])
+
+    def test_batch_endpoint_validates_input(self):
+        self.app.config["TRANSLATION_BATCH_SIZE"] = 2
+        client = self.app.test_client()
+
+        def post(data):
+            return client.post("/translate/batch", json=data).status_code
+
+        self.assertEqual(post({"texts": ["ciao"], "target_language": "en"}), 200)
+        self.assertEqual(post({"texts": ["ciao", 1], "target_language": "en"}), 400)
+        self.assertEqual(post({"texts": ["a", "b", "c"], "target_language": "en"}), 400)
+        self.assertEqual(post({"texts": ["a" * 1001], "target_language": "en"}), 400)
+        self.assertEqual(post({"texts": "ciao", "target_language": "en"}), 400)
+        self.assertEqual(post({"texts": ["ciao"], "target_language": "xx"}), 400)
+        self.assertEqual(post(["ciao"]), 400)
+
+
+class ReplicaCase(unittest.TestCase):
+    # Each request pushes an app context, and so a `g`, of its own
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        url = f"sqlite:///{self.directory.name}"
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = f"{url}/primary.db"
+            SQLALCHEMY_BINDS = {"replica": f"{url}/replica.db"}
+
+        self.app = create_app(ReplicaConfig)
+        with self.app.app_context():
+            db.create_all()
+            db.Model.metadata.create_all(db.get_engine(bind="replica"))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_reads_are_routed_to_the_replica(self):
+        with self.app.app_context():
+            db.session.add(User(username="john", email="john@example.com"))
+            db.session.commit()
+
+        with self.app.test_request_context():
+            prefer_replica()
+            self.assertEqual(User.query.count(), 0)
+
+        with self.app.test_request_context():
+            self.assertEqual(User.query.count(), 1)
+
+    def test_reads_stick_to_the_primary_after_a_commit(self):
+        with self.app.test_request_context():
+            prefer_replica()
+            db.session.add(User(username="john", email="john@example.com"))
+            db.session.commit()
+            self.assertEqual(User.query.count(), 1)
+            response = self.app.process_response(self.app.response_class())
+            self.assertIn("session=", response.headers["Set-Cookie"])
+
+        # A later read-only request from the same browser reads its own write
+        cookie = response.headers["Set-Cookie"].split(";")[0]
+        with self.app.test_request_context(headers={"Cookie": cookie}):
+            self.app.preprocess_request()
+            prefer_replica()
+            self.assertEqual(User.query.count(), 1)
+
+
+class StreamingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.redis = FakeRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(self.user.id)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_publish_on_commit(self):
+        self.user.add_notification("unread_message_count", 3)
+        self.user.add_notification("unread_message_count", 4)
+        self.assertNotIn(f"notifications:{self.user.id}", self.app.redis.data)
+        db.session.commit()
+
+        published = self.app.redis.data[f"notifications:{self.user.id}"]
+        self.assertEqual(len(published), 1)
+        self.assertEqual(json.loads(published[0])["data"], 4)
+
+    def test_stream(self):
+        pubsub = streaming.subscribe(self.user.id)
+        self.user.add_notification("task_progress", {"progress": 50})
+        db.session.commit()
+
+        events = list(streaming.stream(pubsub, ["backlog\n\n"], 0.1, 1))
+        self.assertEqual(events[:2], ["retry: 1000\n\n", "backlog\n\n"])
+        self.assertIn("event: task_progress\n", events[2])
+        self.assertIn('data: {"progress": 50}\n', events[2])
+        self.assertTrue(pubsub.closed)
+
+    def test_stream_endpoint(self):
+        response = self.client.get("/notifications/stream")
+        self.assertEqual(response.status_code, 404)
+
+        self.user.add_notification("unread_message_count", 2)
+        db.session.commit()
+        self.app.config["NOTIFICATION_STREAMING"] = True
+        self.app.config["NOTIFICATION_STREAM_TIMEOUT"] = 0
+        response = self.client.get("/notifications/stream")
+        self.assertEqual(response.mimetype, "text/event-stream")
+        self.assertIn(
+            "event: unread_message_count\ndata: 2\n", response.get_data(as_text=True)
+        )
+
+
+class FragmentCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config["FRAGMENT_CACHE_SIZE"] = 10
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        fragments._local.clear()
+
+    def tearDown(self):
+        fragments._local.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_render_posts(self):
+        u = User(username="john", email="john@example.com")
+        post = Post(body="hello", author=u)
+        db.session.add(post)
+        db.session.commit()
+
+        def render(locale):
+            with self.app.test_request_context():
+                g.locale = locale
+                with mock.patch(
+                    "app.fragments.render_template", wraps=render_template
+                ) as render_template_:
+                    (row,) = fragments.render_posts([post])
+            return row, render_template_.call_count
+
+        row, renders = render("en")
+        self.assertIn("hello", row)
+        self.assertEqual(renders, 1)
+        self.assertEqual(render("en"), (row, 0))
+        self.assertEqual(render("es")[1], 1)
+
+        # Profile changes shown on the row yield a new key
+        u.username = "johnny"
+        db.session.commit()
+        row, renders = render("en")
+        self.assertEqual(renders, 1)
+        self.assertIn("johnny", row)
+
+        u.email = "johnny@example.com"
+        db.session.commit()
+        row, renders = render("en")
+        self.assertEqual(renders, 1)
+        self.assertIn(u.avatar_hash, row)
+
+
+class PaginationCase(unittest.TestCase):
+    def setUp(self):
+        class PaginationConfig(TestConfig):
+            POSTS_PER_PAGE = 2
+
+        self.app = create_app(PaginationConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username="john", email="john@example.com")
+        self.susan = User(username="susan", email="susan@example.com")
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.now = datetime.utcnow()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(self.john.id)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_posts(self, author, offsets, model=Post, **kwargs):
+        """Add one row per offset, timestamped that many seconds from self.now."""
+        rows = [
+            model(
+                body=f"{author.username} {i}",
+                author=author,
+                timestamp=self.now + timedelta(seconds=offset),
+                **kwargs,
+            )
+            for i, offset in enumerate(offsets)
+        ]
+        db.session.add_all(rows)
+        db.session.commit()
+        return rows
+
+    def walk(self, url):
+        """Return the bodies of each page from url on, walking older then newer.
+
+        Both walks must agree; the pages are returned oldest last.
+        """
+
+        def bodies(html):
+            return re.findall(r"<i>(\w+ \d+)</i>", html)
+
+        older = []
+        while url:
+            html = self.client.get(url).get_data(as_text=True)
+            older.append(bodies(html))
+            newer, url = page_links(html)
+
+        newer_pages = [older[-1]]
+        while newer:
+            html = self.client.get(newer).get_data(as_text=True)
+            newer_pages.append(bodies(html))
+            newer = page_links(html)[0]
+        self.assertEqual(newer_pages[::-1], older)
+        return older
+
+    def test_explore(self):
+        # Three posts share a timestamp; the id breaks the tie across pages
+        self.add_posts(self.john, [0, 0, 0, 1, 2])
+        self.assertEqual(
+            self.walk("/explore"),
+            [["john 4", "john 3"], ["john 2", "john 1"], ["john 0"]],
+        )
+
+    def test_index(self):
+        self.john.follow(self.susan)
+        self.add_posts(self.john, [0, 2, 2])
+        self.add_posts(self.susan, [1, 2, 3])
+        self.add_posts(User(username="mary", email="mary@example.com"), [4])
+        self.assertEqual(
+            self.walk("/index"),
+            [["susan 2", "susan 1"], ["john 2", "john 1"], ["susan 0", "john 0"]],
+        )
+
+    def test_messages(self):
+        self.add_posts(self.susan, [0, 0, 0], model=Message, recipient=self.john)
+        self.assertEqual(self.walk("/messages"), [["susan 2", "susan 1"], ["susan 0"]])
+
+    def test_bad_cursor(self):
+        self.add_posts(self.john, [0, 1, 2])
+
+        def cursor(*payload):
+            raw = json.dumps(payload).encode()
+            return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+        for bad in [
+            "not a cursor!",
+            cursor("next", "2020-01-01T00:00:00"),
+            cursor("sideways", "2020-01-01T00:00:00", 1),
+            cursor("next", "yesterday", 1),
+            cursor("next", "2020-01-01T00:00:00", True),
+        ]:
+            self.assertEqual(
+                self.client.get("/explore", query_string={"cursor": bad}).status_code,
+                404,
+            )
+
+        headers = {"Authorization": f"Bearer {self.john.get_token()}"}
+        db.session.commit()
+        response = self.client.get(
+            "/api/users", query_string={"cursor": cursor("next", "1")}, headers=headers
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()["error"], "Not Found")
+
+    def test_api_links(self):
+        db.session.add_all(
+            User(username=f"user{i}", email=f"user{i}@example.com") for i in range(3)
+        )
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {self.john.get_token()}"}
+        db.session.commit()
+
+        pages, url = [], "/api/users?per_page=2"
+        while url:
+            data = self.client.get(url, headers=headers).get_json()
+            pages.append([user["id"] for user in data["items"]])
+            self.assertEqual(data["_links"]["self"], url)
+            self.assertEqual(data["meta"]["total_items"], None)
+            url = data["_links"]["next"]
+        self.assertEqual(pages, [[1, 2], [3, 4], [5]])
+
+        data = self.client.get(data["_links"]["prev"], headers=headers).get_json()
+        self.assertEqual([user["id"] for user in data["items"]], [3, 4])
+        self.assertIsNone(
+            self.client.get(data["_links"]["prev"], headers=headers).get_json()[
+                "_links"
+            ]["prev"]
+        )
+
+        data = self.client.get(
+            "/api/users?per_page=2&include_total=1", headers=headers
+        ).get_json()
+        self.assertEqual(
+            data["meta"], {"per_page": 2, "total_items": 5, "total_pages": 3}
+        )
+
+
+class TimelineCase(unittest.TestCase):
+    def setUp(self):
+        class TimelineConfig(TestConfig):
+            TIMELINE_ENABLED = True
+            TIMELINE_MAX_LENGTH = 5
+            POSTS_PER_PAGE = 4
+
+        self.app = create_app(TimelineConfig)
+        self.app.redis = FakeRedis()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        self.other = User(username="susan", email="susan@example.com")
+        db.session.add_all([self.user, self.other])
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(self.user.id)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_posts(self, author, numbers):
+        now = datetime.utcnow()
+        db.session.add_all(
+            Post(body=f"post {i}", author=author, timestamp=now + timedelta(i))
+            for i in numbers
+        )
+        db.session.commit()
+
+    def walk(self):
+        """Return the post bodies of every home page, following the older links."""
+        bodies, url = [], "/index"
+        while url:
+            html = self.client.get(url).get_data(as_text=True)
+            bodies += re.findall(r"<i>(post \d+)</i>", html)
+            url = page_links(html)[1]
+        return bodies
+
+    def posts(self, numbers):
+        return [f"post {i}" for i in numbers]
+
+    def test_fill(self):
+        self.assertEqual(self.walk(), [])
+        # The empty timeline is warm, so new posts are pushed onto it
+        self.assertEqual(timeline.page(self.user.id, None, 4), ([], 0, 0, False))
+        self.add_posts(self.user, range(3))
+        self.assertEqual(timeline.page(self.user.id, None, 4)[2:], (3, False))
+        self.assertEqual(self.walk(), self.posts([2, 1, 0]))
+
+    def test_fan_out(self):
+        self.user.follow(self.other)
+        db.session.commit()
+        self.walk()
+
+        self.add_posts(self.other, range(2))
+        self.assertEqual(timeline.page(self.user.id, None, 4)[2], 2)
+        # Cold timelines are left to be rebuilt on their next read
+        self.assertNotIn(f"timeline:{self.other.id}", self.app.redis.data)
+        self.assertEqual(self.walk(), self.posts([1, 0]))
+
+        self.user.unfollow(self.other)
+        db.session.commit()
+        self.assertEqual(self.walk(), [])
+
+    def test_trim(self):
+        self.walk()
+        self.add_posts(self.user, range(3))
+        self.assertFalse(timeline.page(self.user.id, None, 4)[3])
+
+        # Pushing past TIMELINE_MAX_LENGTH drops the oldest posts
+        self.add_posts(self.user, range(3, 7))
+        self.assertEqual(timeline.page(self.user.id, None, 4)[2:], (5, True))
+        self.assertEqual(self.walk(), self.posts(range(6, -1, -1)))
+
+    def test_removal_from_trimmed_timeline(self):
+        self.add_posts(self.user, range(12))
+        self.assertEqual(self.walk(), self.posts(range(11, -1, -1)))
+        self.assertEqual(timeline.page(self.user.id, None, 4)[2:], (5, True))
+
+        # The shrunk timeline still knows that older posts are only in SQL
+        db.session.delete(Post.query.filter_by(body="post 8").one())
+        db.session.commit()
+        self.assertEqual(timeline.page(self.user.id, None, 4)[2:], (4, True))
+        expected = [i for i in range(11, -1, -1) if i != 8]
+        self.assertEqual(self.walk(), self.posts(expected))
+
+    def test_fallback(self):
+        self.add_posts(self.user, range(6))
+        self.walk()
+
+        # An evicted timeline is served by SQL, from the page's cursor on
+        html = self.client.get("/index").get_data(as_text=True)
+        self.app.redis.delete(f"timeline:{self.user.id}")
+        html = self.client.get(page_links(html)[1]).get_data(as_text=True)
+        self.assertEqual(re.findall(r"<i>(post \d+)</i>", html), self.posts([1, 0]))
+
+        with mock.patch.object(
+            self.app.redis, "pipeline", side_effect=RedisConnectionError
+        ):
+            self.assertEqual(self.walk(), self.posts(range(5, -1, -1)))
+
+
+class ExportCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        class ExportConfig(TestConfig):
+            # A file database, on which a pending read blocks progress commits
+            SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(
+                self.directory.name, "app.db"
+            )
+            EXPORT_DIR = self.directory.name
+            EXPORT_BATCH_SIZE = 2
+            EXPORT_PROGRESS_INTERVAL = 3600
+
+        self.app = create_app(ExportConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        now = datetime.utcnow()
+        db.session.add_all(
+            Post(body=f"post {i}", author=self.user, timestamp=now + timedelta(i))
+            for i in range(5)
+        )
+        self.task = Task(id="abc", name="export_posts", user=self.user)
+        db.session.add(self.task)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.directory.cleanup()
+
+    def test_export_is_streamed(self):
+        progress = []
+        self.assertEqual(self.task.write_export(progress.append), 5)
+        self.assertEqual(progress, [40, 80, 99])
+
+        with gzip.open(self.task.get_export_path(), "rt") as f:
+            posts = [json.loads(line) for line in f]
+        self.assertEqual([p["body"] for p in posts], [f"post {i}" for i in range(5)])
+        self.assertTrue(posts[0]["timestamp"].endswith("Z"))
+
+    def test_export_commits_progress(self):
+        def report_progress(progress):
+            self.user.add_notification("task_progress", {"progress": progress})
+            db.session.commit()
+
+        self.assertEqual(self.task.write_export(report_progress), 5)
+        self.assertEqual(
+            [n.get_payload()["progress"] for n in self.user.notifications], [99]
+        )
+        self.assertTrue(os.path.exists(self.task.get_export_path()))
+
+    def test_download(self):
+        self.task.write_export(lambda progress: None)
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(self.user.id)
+        self.assertEqual(client.get("/export_posts/abc").status_code, 404)
+
+        self.task.complete = True
+        db.session.commit()
+        response = client.get("/export_posts/abc")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(gzip.decompress(response.data).splitlines()), 5)
+
+        # Expired exports are purged, after which the download is gone
+        path = self.task.get_export_path()
+        os.utime(path, (0, 0))
+        self.assertEqual(Task.purge_exports(3600), 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(client.get("/export_posts/abc").status_code, 404)
+
+
+class EmailCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_password_reset_email(self):
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        db.session.commit()
+        with mail.record_messages() as outbox, self.app.test_request_context():
+            send_password_reset_email(u)
+        self.assertEqual([m.recipients for m in outbox], [["john@example.com"]])
+
+    def test_queued_emails_are_sent_by_one_job(self):
+        self.app.config["MAIL_ASYNC"] = True
+        self.app.redis = FakeRedis()
+        self.app.task_queue = mock.Mock()
+        for i in range(3):
+            send_email(f"hi {i}", "a@example.com", ["b@example.com"], "text", "html")
+        self.app.task_queue.enqueue.assert_called_once_with("app.tasks.send_emails")
+
+        with mail.record_messages() as outbox:
+            with mock.patch.object(mail, "connect", wraps=mail.connect) as connect:
+                deliver(take_queued_emails())
+        self.assertEqual([m.subject for m in outbox], ["hi 0", "hi 1", "hi 2"])
+        self.assertEqual(connect.call_count, 1)
+
+        # The next email queues a new job
+        send_email("hi", "a@example.com", ["b@example.com"], "text", "html")
+        self.assertEqual(self.app.task_queue.enqueue.call_count, 2)
+
+    def test_delivery_is_retried(self):
+        messages = [
+            MailMessage(f"hi {i}", sender="a@example.com", recipients=["b@example.com"])
+            for i in range(3)
+        ]
+        connect = mail.connect
+        failures = [ConnectionRefusedError(), connect(), connect()]
+        with mail.record_messages() as outbox:
+            with mock.patch.object(mail, "connect", side_effect=failures):
+                self.assertEqual(deliver(messages), [])
+        self.assertEqual(len(outbox), 3)
+
+    def test_rejected_email_is_dropped(self):
+        self.app.redis = FakeRedis()
+        messages = [
+            MailMessage(f"hi {i}", sender="a@example.com", recipients=["b@example.com"])
+            for i in range(4)
+        ]
+        sent = []
+
+        def send(message):
+            if message.subject == "hi 1":
+                raise smtplib.SMTPDataError(554, b"Message rejected")
+            if message.subject == "hi 2":
+                raise smtplib.SMTPServerDisconnected()
+            sent.append(message.subject)
+
+        conn = mock.MagicMock()
+        conn.__enter__.return_value.send.side_effect = send
+        self.app.config["MAIL_RETRIES"] = 1
+        with mock.patch.object(mail, "connect", return_value=conn):
+            pending = deliver(messages)
+        # The rejected message is dropped, the rest carry on until the outage
+        self.assertEqual(sent, ["hi 0"])
+        self.assertEqual([m.subject for m in pending], ["hi 2", "hi 3"])
+
+        # Unsent messages go back to the head of the outbox
+        self.app.redis.rpush(OUTBOX_KEY, pickle.dumps(messages[0]))
+        requeue_emails(pending)
+        queued = [m.subject for m in take_queued_emails()]
+        self.assertEqual(queued, ["hi 2", "hi 3", "hi 0"])
+
+
+class ConditionalRequestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_unchanged_user_is_not_modified(self):
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {token}"}
+
+        response = self.client.get(f"/api/users/{u.id}", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Cache-Control"], "private, no-cache")
+        # last_seen would not change with about_me or the counters
+        self.assertNotIn("Last-Modified", response.headers)
+        etag = response.headers["ETag"]
+
+        headers["If-None-Match"] = etag
+        response = self.client.get(f"/api/users/{u.id}", headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b"")
+
+        u.about_me = "changed"
+        db.session.commit()
+        response = self.client.get(f"/api/users/{u.id}", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_compressed_collection(self):
+        users = [
+            User(username=f"user{i}", email=f"user{i}@example.com") for i in range(20)
+        ]
+        db.session.add_all(users)
+        token = users[0].get_token()
+        db.session.commit()
+        headers = {"Authorization": f"Bearer {token}", "Accept-Encoding": "gzip"}
+
+        response = self.client.get("/api/users?per_page=20", headers=headers)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response.headers["Vary"])
+        data = json.loads(gzip.decompress(response.get_data()))
+        self.assertEqual(len(data["items"]), 20)
+
+        headers["If-None-Match"] = response.headers["ETag"]
+        response = self.client.get("/api/users?per_page=20", headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+    def test_json_escaping(self):
+        u = User(username="john", email="john@example.com", about_me="caf\u00e9 \u2603")
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+
+        # The API sends UTF-8, pages keep ASCII-only JSON for inline scripts
+        response = self.client.get(
+            f"/api/users/{u.id}", headers={"Authorization": f"Bearer {token}"}
+        )
+        self.assertIn("caf\u00e9 \u2603".encode("utf-8"), response.get_data())
+        with self.app.test_request_context():
+            rendered = render_template_string("{{ s|tojson }}", s=u.about_me)
+        self.assertEqual(rendered, '"caf\\u00e9 \\u2603"')
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config["SERVER_TIMING"] = True
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_request_queries_are_recorded(self):
+        response = self.client.post(
+            "/api/tokens", headers={"Authorization": "Basic am9objpjYXQ="}
+        )
+        self.assertEqual(response.status_code, 401)
+        self.assertIn('desc="1 queries"', response.headers["Server-Timing"])
+
+        body = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn(
+            'microblog_request_queries_bucket{endpoint="api.get_token",le="1"}', body
+        )
+        self.assertIn('microblog_slowest_query_seconds{endpoint="api.get_token"', body)
+        self.assertIn('microblog_token_cache_lookups_total{result="misses"}', body)
+
+    def test_metrics_access(self):
+        self.app.config["METRICS_TOKEN"] = "secret"
+        remote = {"REMOTE_ADDR": "10.0.0.1"}
+        self.assertEqual(
+            self.client.get("/metrics", environ_base=remote).status_code, 403
+        )
+        response = self.client.get(
+            "/metrics", environ_base=remote, headers={"Authorization": "Bearer secret"},
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_statement_fingerprint(self):
+        self.assertEqual(
+            metrics.fingerprint("SELECT * FROM user WHERE id IN (?, ?) AND name = 'a'"),
+            metrics.fingerprint(
+                "SELECT *  FROM user WHERE id IN (?) AND name = 'b''c'"
+            ),
+        )
+        self.assertNotEqual(
+            metrics.fingerprint("SELECT * FROM user WHERE id = 1"),
+            metrics.fingerprint("SELECT * FROM post WHERE id = 1"),
+        )
+
+
+class TemplateCacheCase(unittest.TestCase):
+    def test_warm_up_fills_the_bytecode_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+
+            class CacheConfig(TestConfig):
+                TEMPLATE_CACHE_DIR = directory
+
+            app = create_app(CacheConfig)
+            loaded = templating.warm_up(app)
+            self.assertGreater(loaded, 0)
+            self.assertEqual(len(os.listdir(directory)), loaded)
+
+            # A fresh worker reads the bytecode instead of compiling again
+            app = create_app(CacheConfig)
+            with mock.patch.object(app.jinja_env, "compile") as compile:
+                self.assertEqual(templating.warm_up(app), loaded)
+            compile.assert_not_called()
+
+
+class AppProfileCase(unittest.TestCase):
+    def test_clients_are_created_on_first_use(self):
+        app = create_app(TestConfig)
+        self.assertNotIn("redis", app.__dict__)
+        self.assertNotIn("task_queue", app.__dict__)
+        self.assertIs(app.task_queue.connection, app.redis)
+        self.assertIsNone(app.elasticsearch)
+
+    def test_worker_profile(self):
+        app = create_app(TestConfig, profile="worker")
+        self.assertEqual(app.blueprints, {})
+        with app.test_request_context(base_url="https://example.com"):
+            self.assertEqual(
+                url_for("main.download_export", task_id="abc", _external=True),
+                "https://example.com/export_posts/abc",
+            )
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)